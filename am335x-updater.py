@@ -3,20 +3,28 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import concurrent.futures
 import contextlib
 import enum
 import functools
 import hashlib
 import io
+import json
 import logging
 import math
 import os
 import os.path
 import re
+import socket
 import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import typing
+import zlib
 
 import yaml
 
@@ -30,15 +38,236 @@ logging.basicConfig(
 )
 
 
-DEFAULT_SECTOR_SIZE = 512
+#: The default longest time (in seconds) a single step of a long operation
+#: should take when running under a systemd watchdog.
+DEFAULT_MAX_STEP_LATENCY = 1.0
 
+#: The size of the first step of a copy when steps are being bounded.
+INITIAL_STEP_SIZE = 64 * 1024
 
-def get_block_size(device: os.PathLike) -> int:
-    """Look up the device block size (in bytes) in sysfs.
+#: The smallest step a bounded operation is broken into, however slow the
+#: device is.
+MIN_STEP_SIZE = 4 * 1024
 
-    This value is also used as the sector size in this script. If there's an
-    error in looking up the4 value, 512 is used.
+
+class Watchdog(object):
+    """Keep a systemd watchdog fed during long operations.
+
+    When running under a systemd watchdog (``NOTIFY_SOCKET`` and
+    ``WATCHDOG_USEC`` set), `step` sends ``WATCHDOG=1`` (and optionally
+    ``STATUS=``) notifications. Long operations (hashing, copying and flushing)
+    are broken into steps that should each take less than `max_step_latency`
+    seconds, with `step` called in between. Without a watchdog, this does
+    nothing and operations are not split up.
+    """
+
+    #: The longest time (in seconds) a single step should take.
+    max_step_latency: float
+
+    #: The address of the systemd notification socket, or `None` when there's
+    #: no watchdog to feed.
+    notify_socket: typing.Optional[str]
+
+    def __init__(
+        self,
+        max_step_latency: float = DEFAULT_MAX_STEP_LATENCY,
+        notify_socket: typing.Optional[str] = None,
+    ):
+        self.max_step_latency = max_step_latency
+        self.notify_socket = notify_socket
+        self._socket: typing.Optional[socket.socket] = None
+        self._last_ping = 0.0
+
+    @classmethod
+    def from_environment(
+        cls,
+        max_step_latency: typing.Optional[float] = None,
+    ) -> Watchdog:
+        """Create a watchdog using the environment variables systemd sets.
+
+        The watchdog is only enabled if both ``NOTIFY_SOCKET`` and
+        ``WATCHDOG_USEC`` are set, and (like ``sd_watchdog_enabled()``) if
+        ``WATCHDOG_PID`` is either unset or the PID of this process, so child
+        processes that inherit the variables don't feed it. If
+        `max_step_latency` is not given, it defaults to a quarter of
+        ``WATCHDOG_USEC``.
+        """
+        notify_socket = os.environ.get("NOTIFY_SOCKET") or None
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        watchdog_pid = os.environ.get("WATCHDOG_PID")
+        disabled = cls(
+            DEFAULT_MAX_STEP_LATENCY
+            if max_step_latency is None
+            else max_step_latency
+        )
+        if notify_socket is None or watchdog_usec is None:
+            return disabled
+        try:
+            timeout = int(watchdog_usec) / 1e6
+            if watchdog_pid is not None and int(watchdog_pid) != os.getpid():
+                log.debug("The watchdog is for process %s", watchdog_pid)
+                return disabled
+        except ValueError:
+            log.warning(
+                "Invalid WATCHDOG_USEC '%s' or WATCHDOG_PID '%s'",
+                watchdog_usec,
+                watchdog_pid,
+            )
+            return disabled
+        if timeout <= 0:
+            return disabled
+        if max_step_latency is None:
+            max_step_latency = timeout / 4
+        return cls(max_step_latency, notify_socket)
+
+    @property
+    def enabled(self) -> bool:
+        """If notifications are being sent to systemd."""
+        return self.notify_socket is not None
+
+    def notify(self, *assignments: str):
+        """Send a notification (like "READY=1") to systemd."""
+        if not self.enabled:
+            return
+        address = self.notify_socket
+        # Abstract socket addresses are given with a leading "@"
+        if address.startswith("@"):
+            address = "\0" + address[1:]
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(
+                    socket.AF_UNIX,
+                    socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+                )
+                # A backed up listener shouldn't hold up an update
+                self._socket.setblocking(False)
+            self._socket.sendto("\n".join(assignments).encode(), address)
+        except OSError as exc:
+            log.debug("Unable to notify systemd: %s", exc)
+
+    def step(self, status: typing.Optional[str] = None):
+        """Mark the end of a step, feeding the watchdog.
+
+        Without a `status`, the watchdog is only fed if it hasn't been recently,
+        so this can be called as often as needed.
+        """
+        now = time.monotonic()
+        if status is None:
+            if now - self._last_ping < self.max_step_latency / 4:
+                return
+            self.notify("WATCHDOG=1")
+        else:
+            self.notify("WATCHDOG=1", f"STATUS={status}")
+        self._last_ping = now
+
+    def first_step_size(self, total: int, alignment: int = 1) -> int:
+        """The size of the first step when processing `total` bytes.
+
+        When not running under systemd, everything is done in one step.
+        """
+        if not self.enabled:
+            return total
+        return max(alignment, align_down(INITIAL_STEP_SIZE, alignment))
+
+    def next_step_size(
+        self,
+        step_size: int,
+        elapsed: float,
+        alignment: int = 1,
+    ) -> int:
+        """Size the next step from how long the last one took.
+
+        Steps are aimed at half of `max_step_latency`, and at most double in
+        size from one step to the next.
+        """
+        if not self.enabled:
+            return step_size
+        target = step_size * 2
+        if elapsed > 0:
+            rate = step_size / elapsed
+            target = min(target, rate * self.max_step_latency / 2)
+        target = max(MIN_STEP_SIZE, int(target))
+        return max(alignment, align_down(target, alignment))
+
+    def run_in_steps(
+        self,
+        total: int,
+        do_step: typing.Callable[[int, int], int],
+        status: str,
+        alignment: int = 1,
+    ) -> int:
+        """Process `total` bytes in steps sized to `max_step_latency`.
+
+        `do_step` is called with the position and size of each step, and
+        returns how many bytes it handled. A progress `status` is reported after
+        each step. The total number of bytes handled is returned.
+        """
+        position = 0
+        step_size = self.first_step_size(total, alignment)
+        while position < total:
+            start = time.monotonic()
+            done = do_step(position, min(step_size, total - position))
+            if done == 0:
+                break
+            position += done
+            self.step(f"{status}: {position}/{total} bytes")
+            step_size = self.next_step_size(
+                step_size,
+                time.monotonic() - start,
+                alignment,
+            )
+        return position
+
+
+#: The watchdog used by long operations. `main` replaces it with one
+#: configured from the environment.
+watchdog = Watchdog()
+
+
+class ReadCounter(object):
+    """Count the bytes of device and image data read, across threads."""
+
+    #: The number of bytes read so far.
+    total: int
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def add(self, size: int):
+        """Count `size` more bytes as read."""
+        with self._lock:
+            self.total += size
+
+
+#: Counts every read of device and image data, for `UpdateMetrics`.
+read_counter = ReadCounter()
+
+
+class CountingFileIO(io.FileIO):
+    """An `io.FileIO` that counts what it reads in `read_counter`."""
+
+    def readinto(self, buffer) -> typing.Optional[int]:
+        size = super().readinto(buffer)
+        if size:
+            read_counter.add(size)
+        return size
+
+
+def open_for_reading(path: os.PathLike) -> io.BufferedReader:
+    """Open a device or image file for reading, counting what is read.
+
+    Reads are counted as they reach the file, so the read-ahead of the buffer is
+    included.
     """
+    return io.BufferedReader(CountingFileIO(path, "rb"))
+
+
+DEFAULT_SECTOR_SIZE = 512
+
+
+def get_sysfs_path(device: os.PathLike) -> str:
+    """Find the sysfs directory for a block device."""
     device_path: typing.Union[str, bytes]
     if isinstance(device, os.PathLike):
         device_path = device.__fspath__()
@@ -59,7 +288,22 @@ def get_block_size(device: os.PathLike) -> int:
     # whitespace, or has no characters at all.
     assert match is not None
     device_name = match.group(1)
-    block_size_path = f"/sys/class/block/{device_name}/queue/logical_block_size"
+    if isinstance(device_name, bytes):
+        device_name = os.fsdecode(device_name)
+    return f"/sys/class/block/{device_name}"
+
+
+def get_block_size(device: os.PathLike) -> int:
+    """Look up the device block size (in bytes) in sysfs.
+
+    This value is also used as the sector size in this script. If there's an
+    error in looking up the4 value, 512 is used.
+    """
+    block_size_path = os.path.join(
+        get_sysfs_path(device),
+        "queue",
+        "logical_block_size",
+    )
     if not os.path.exists(block_size_path):
         log.warning(
             "'%s' is not a block device, defaulting to %d-byte sectors",
@@ -72,6 +316,61 @@ def get_block_size(device: os.PathLike) -> int:
         return int(sys_block_size.read().strip())
 
 
+class EraseGeometry(typing.NamedTuple):
+    """The sizes (in bytes) that writes to a device should be aligned to."""
+
+    #: The logical block size, see `get_block_size`.
+    logical_block_size: int
+
+    #: The erase block size, or 0 if it's unknown.
+    erase_size: int
+
+    #: The optimal I/O size, or 0 if it's unknown.
+    optimal_io_size: int
+
+    def alignments(self) -> typing.Sequence[int]:
+        """The usable alignments, from largest to smallest.
+
+        Sizes that are unknown or not a multiple of the logical block size are
+        skipped. The logical block size is always the last value.
+        """
+        candidates = {
+            size
+            for size in (self.erase_size, self.optimal_io_size)
+            if size > 0 and size % self.logical_block_size == 0
+        }
+        candidates.add(self.logical_block_size)
+        return sorted(candidates, reverse=True)
+
+
+def get_erase_geometry(device: os.PathLike) -> EraseGeometry:
+    """Look up the erase geometry for a device in sysfs.
+
+    The erase size is taken from the MMC ``preferred_erase_size`` attribute if
+    it's present, and the block layer's ``discard_granularity`` otherwise. Any
+    values that cannot be read are reported as 0.
+    """
+    sysfs_path = get_sysfs_path(device)
+
+    def read_attribute(*path_parts: str) -> int:
+        attribute_path = os.path.join(sysfs_path, *path_parts)
+        try:
+            with open(attribute_path, "r") as attribute:
+                return int(attribute.read().strip())
+        except (OSError, ValueError) as exc:
+            log.debug("Unable to read '%s': %s", attribute_path, exc)
+            return 0
+
+    erase_size = read_attribute("device", "preferred_erase_size")
+    if erase_size == 0:
+        erase_size = read_attribute("queue", "discard_granularity")
+    return EraseGeometry(
+        get_block_size(device),
+        erase_size,
+        read_attribute("queue", "optimal_io_size"),
+    )
+
+
 def find_mbr_first_partition(
     stream: io.BinaryIO,
     sector_size: int = DEFAULT_SECTOR_SIZE,
@@ -155,6 +454,25 @@ class InvalidFirmwareImage(Exception):
     pass
 
 
+# Instead of manually verifying each field, the entire TOC is compared. The
+# contents are fixed (this is what U-Boot's mkimage writes for omapimage files),
+# even though a quick read of the documentation looks like it might be used in
+# other places where the content could vary. The layout is:
+# * A TOC item for the CHSETTINGS section (offset 0x40, size 0xc)
+# * A TOC item filled with 0xff, terminating the TOC
+# * The CHSETTINGS section itself (key, valid, version, reserved, flags)
+# * Zero padding out to 512 bytes
+MLO_TOC = b"".join((
+    struct.pack("<2I12s12s", 0x40, 0xc, b"", b"CHSETTINGS"),
+    b"\xff" * 32,
+    struct.pack("<I2BHI", 0xc0c0c0c1, 0, 1, 0, 0),
+)).ljust(512, b"\x00")
+
+
+#: The size of the GP header (image size and load address) after the TOC.
+MLO_GP_HEADER_SIZE = 8
+
+
 def get_mlo_toc_size(
     stream: io.BinaryIO
 ) -> int:
@@ -165,36 +483,22 @@ def get_mlo_toc_size(
     the data found is not an MLO image, `InvalidFirmwareImage` is raised.
     """
     starting_offset = stream.tell()
-    # Instead of manually verifying each field, I'm just going to hash the
-    # entire TOC. The contents are fixed, even though a quick read of the
-    # documentation looks like it might be used in other places where the
-    # content could vary.
-    TOC_LEN = 512
-    toc_hasher = hashlib.sha256(stream.read(TOC_LEN))
-    toc_hex = toc_hasher.hexdigest()
-    log.debug("TOC hash for %s at %#x: %s", stream, starting_offset, toc_hex)
-    expected_hash = (
-        "21a542439d495f829f448325a75a2a377bf84c107751fe77a0aeb321d1e23868"
-    ) 
-    if toc_hex != expected_hash:
-        msg = (
-            f"TOC hash at {stream}, offset {starting_offset:#x} did not match",
-        )
-        raise InvalidFirmwareImage(msg)
-    else:
-        log.debug(
-            "TOC hash at %s, offset %#x matched",
-            stream,
-            starting_offset
+    toc = stream.read(len(MLO_TOC))
+    if toc != MLO_TOC:
+        raise InvalidFirmwareImage(
+            f"TOC at {stream}, offset {starting_offset:#x} did not match"
         )
-    # Read the size of the image right after the TOC. The first 4 bytes are a
-    # little-endian unsigned int representing the size of the image in bytes.
-    # The size does not include the TOC size.
+    else:
+        log.debug("TOC at %s, offset %#x matched", stream, starting_offset)
+    # Read the size of the image right after the TOC. The GP header is a
+    # little-endian unsigned int representing the size of the image in bytes,
+    # followed by the load address. The size includes neither the TOC nor the
+    # GP header itself.
     # Relying on the read position of stream being where it was left from
     # reading the TOC.
     image_len_buf = stream.read(4)
     image_len = struct.unpack_from("<I", image_len_buf)[0]
-    return image_len + TOC_LEN
+    return image_len + len(MLO_TOC) + MLO_GP_HEADER_SIZE
 
 
 class InvalidUBootImage(InvalidFirmwareImage):
@@ -242,51 +546,42 @@ def align_up(n: int, align_to: int) -> int:
     return align_to * math.ceil(n / align_to)
 
 
-def get_u_boot_fit_size(
-    stream: io.BinaryIO,
-) -> int:
-    """Determine the size of a possible U-Boot FIT image.
+def align_down(n: int, align_to: int) -> int:
+    """Return `n`, rounded down to `align_to`."""
+    return align_to * (n // align_to)
 
-    The given stream is checked starting from its current position. If a valid
-    U-Boot FIT image is found there, the total size in bytes of the image is
-    returned. If no image is found, an `InvalidFirmwareImage` exception will be raised.
+
+#: The path to the device tree compiler.
+DTC_PATH = "/usr/bin/dtc"
+
+
+def read_fdt_header(stream: io.BinaryIO) -> int:
+    """Check for an FDT at the current position of a stream, returning its size.
+
+    The stream is left at the position it started at. If there is no FDT there,
+    `InvalidFirmwareImage` is raised.
     """
     starting_offset = stream.tell()
     # The first 8 bytes of a flattened device tree (FDT) are a magic number, and
     # the total size of the FDT.
     buf = stream.read(8)
+    stream.seek(starting_offset, os.SEEK_SET)
+    if len(buf) < 8:
+        raise InvalidFirmwareImage(
+            f"{stream} ended at {starting_offset:#x} before an FDT header"
+        )
     magic, fdt_len = struct.unpack(">2I", buf)
     if magic != 0xd00dfeed:
         raise InvalidFirmwareImage(
             f"Magic number for {stream} at {starting_offset:#x} does not match"
             " for an FDT"
         )
-    # Extract the FDT from the device (and only the FDT, which we can do because
-    # the size is now known). Feed it into dtc to decompile it, then convert the
-    # DTS to YAML for easier parsing.
-    stream.seek(starting_offset, os.SEEK_SET)
-    read_pipe, write_pipe = os.pipe()
-    # Fork so we can have a process feed the data in to the pipe.
-    if os.fork() != 0:
-        os.close(write_pipe)
-    else:
-        os.close(read_pipe)
-        fdt_data = stream.read(fdt_len)
-        os.write(write_pipe, fdt_data)
-        os.close(write_pipe)
-        sys.exit()
-    decompile = subprocess.Popen(
-        ["/usr/bin/dtc", "-I", "dtb", "-O", "dts", "-o", "-", "-"],
-        stdin=read_pipe,
-        stdout=subprocess.PIPE,
-        close_fds=True,
-    )
-    yaml_convert = subprocess.Popen(
-        ["/usr/bin/dtc", "-I", "dts", "-O", "yaml", "-o", "-", "-"],
-        stdin=decompile.stdout,
-        stdout=subprocess.PIPE,
-    )
-    fit_yaml = yaml.safe_load_all(yaml_convert.communicate()[0])
+    return fdt_len
+
+
+def get_fit_size_from_yaml(fdt_len: int, fit_yaml_data: bytes) -> int:
+    """Determine the size of a FIT image from `dtc`'s YAML output for it."""
+    fit_yaml = yaml.safe_load_all(fit_yaml_data)
     # FIT uses the DTS format, with a couple of differences. We only care about
     # the "images" nodes. To figure out the size of the FIT image, we look at
     # the "data-size" and "data-offset" properties of the image nodes.
@@ -319,7 +614,7 @@ def get_u_boot_fit_size(
                 offset_size = image_size
             if image_type == "firmware" and image_os == "u-boot":
                 uboot_image_found = True
-    except (KeyError, IndexError) as exc:
+    except (KeyError, IndexError, StopIteration) as exc:
         raise InvalidFirmwareImage("Invalid access in FIT parsing") from exc
     if not uboot_image_found:
         raise InvalidUBootImage(
@@ -331,6 +626,309 @@ def get_u_boot_fit_size(
     return align_up(fdt_len, 4) + align_up(extra_len, 4)
 
 
+def get_u_boot_fit_size(
+    stream: io.BinaryIO,
+) -> int:
+    """Determine the size of a possible U-Boot FIT image.
+
+    The given stream is checked starting from its current position. If a valid
+    U-Boot FIT image is found there, the total size in bytes of the image is
+    returned. If no image is found, an `InvalidFirmwareImage` exception will be raised.
+    """
+    fdt_len = read_fdt_header(stream)
+    # Extract the FDT from the device (and only the FDT, which we can do because
+    # the size is now known). Feed it into dtc to decompile it, then convert the
+    # DTS to YAML for easier parsing.
+    fdt_data = stream.read(fdt_len)
+    dts_data = run_dtc("dtb", "dts", fdt_data)
+    fit_yaml_data = run_dtc("dts", "yaml", dts_data)
+    return get_fit_size_from_yaml(fdt_len, fit_yaml_data)
+
+
+def run_dtc(input_format: str, output_format: str, data: bytes) -> bytes:
+    """Convert `data` between formats with `dtc`.
+
+    The data is fed to `dtc` through a pipe (instead of forking a process to
+    write it, which isn't safe once there are other threads running).
+    `InvalidFirmwareImage` is raised if `dtc` fails.
+    """
+    process = subprocess.Popen(
+        [DTC_PATH, "-I", input_format, "-O", output_format, "-o", "-", "-"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    with process:
+        try:
+            # Keep the watchdog fed while waiting on dtc. The input is only
+            # given the first time, communicate() keeps track of it after that.
+            communicate_input: typing.Optional[bytes] = data
+            while True:
+                try:
+                    stdout, stderr = process.communicate(
+                        communicate_input,
+                        timeout=watchdog.max_step_latency,
+                    )
+                except subprocess.TimeoutExpired:
+                    communicate_input = None
+                    watchdog.step("Waiting for dtc")
+                else:
+                    break
+        except BaseException:
+            process.kill()
+            raise
+    if process.returncode != 0:
+        raise InvalidFirmwareImage(
+            f"dtc failed to convert {input_format} to {output_format}: "
+            f"{stderr.decode(errors='replace').strip()}"
+        )
+    return stdout
+
+
+async def run_dtc_async(
+    input_format: str,
+    output_format: str,
+    data: bytes,
+) -> bytes:
+    """Convert `data` between formats with `dtc` in an asyncio subprocess.
+
+    If the calling task is cancelled, `dtc` is killed. `InvalidFirmwareImage` is
+    raised if `dtc` fails.
+    """
+    process = await asyncio.create_subprocess_exec(
+        DTC_PATH, "-I", input_format, "-O", output_format, "-o", "-", "-",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await process.communicate(data)
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise InvalidFirmwareImage(
+            f"dtc failed to convert {input_format} to {output_format}: "
+            f"{stderr.decode(errors='replace').strip()}"
+        )
+    return stdout
+
+
+async def get_u_boot_fit_size_async(
+    stream: io.BinaryIO,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+) -> int:
+    """Determine the size of a possible U-Boot FIT image without blocking.
+
+    This is the same as `get_u_boot_fit_size`, but the stream is read in
+    `executor` (see `run_blocking`), and `dtc` is run as an asyncio subprocess.
+    """
+    def read_fdt() -> typing.Tuple[int, bytes]:
+        fdt_len = read_fdt_header(stream)
+        return fdt_len, stream.read(fdt_len)
+
+    fdt_len, fdt_data = await run_blocking(executor, read_fdt)
+    dts_data = await run_dtc_async("dtb", "dts", fdt_data)
+    fit_yaml_data = await run_dtc_async("dts", "yaml", dts_data)
+    return get_fit_size_from_yaml(fdt_len, fit_yaml_data)
+
+
+class Crc32Hasher(object):
+    """A `hashlib`-like wrapper around `zlib.crc32`.
+
+    CRC32 is only useful for detecting if two images differ, it is not a
+    secure hash.
+    """
+
+    name = "crc32"
+
+    def __init__(self, data: bytes = b""):
+        self._crc = zlib.crc32(data)
+
+    def update(self, data: bytes):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self) -> str:
+        return f"{self._crc:08x}"
+
+
+#: The digest algorithms that can be used for comparing images, mapped to a
+#: constructor for a `hashlib`-like hasher object.
+DIGEST_ALGORITHMS: typing.Mapping[str, typing.Callable[..., typing.Any]] = {
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    "crc32": Crc32Hasher,
+}
+
+DEFAULT_DIGEST = "sha256"
+
+#: A pseudo-algorithm name, meaning "whichever algorithm is fastest here".
+AUTO_DIGEST = "auto"
+
+
+@functools.lru_cache(maxsize=None)
+def benchmark_digests(
+    sample_size: int = 256 * 1024,
+    rounds: int = 3,
+) -> str:
+    """Find the fastest digest algorithm on this machine.
+
+    Each algorithm in `DIGEST_ALGORITHMS` hashes `sample_size` bytes `rounds`
+    times, and the name of the algorithm with the lowest best time is returned.
+    The result is cached, so the benchmark is only run once per process.
+    """
+    sample = bytes(sample_size)
+    timings = {}
+    for name, constructor in DIGEST_ALGORITHMS.items():
+        best = math.inf
+        for _ in range(rounds):
+            start = time.perf_counter()
+            constructor(sample).hexdigest()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+        log.debug("%s hashed %d bytes in %.6fs", name, sample_size, best)
+    fastest = min(timings, key=timings.__getitem__)
+    log.info("Using %s as the fastest digest algorithm", fastest)
+    return fastest
+
+
+def resolve_digest_name(digest_name: str) -> str:
+    """Turn a digest name (possibly `AUTO_DIGEST`) into a concrete name.
+
+    `ValueError` is raised for unknown digest names.
+    """
+    if digest_name == AUTO_DIGEST:
+        return benchmark_digests()
+    if digest_name not in DIGEST_ALGORITHMS:
+        raise ValueError(f"Unknown digest algorithm '{digest_name}'")
+    return digest_name
+
+
+def new_hasher(digest_name: str, data: bytes = b""):
+    """Create a new `hashlib`-like hasher for the given digest name."""
+    return DIGEST_ALGORITHMS[resolve_digest_name(digest_name)](data)
+
+
+#: The size of each read when hashing image data.
+HASH_CHUNK_SIZE = 128 * 1024
+
+
+def hash_range(
+    path: os.PathLike,
+    offset: int,
+    size: int,
+    hasher,
+    chunk_size: int = HASH_CHUNK_SIZE,
+    pipelined: typing.Optional[bool] = None,
+):
+    """Feed `size` bytes starting at `offset` of a file into `hasher`.
+
+    This is `hash_extents` with a single extent. The hasher is returned.
+    """
+    return hash_extents(path, [(offset, size)], hasher, chunk_size, pipelined)
+
+
+def hash_extents(
+    path: os.PathLike,
+    extents: typing.Sequence[typing.Tuple[int, int]],
+    hasher,
+    chunk_size: int = HASH_CHUNK_SIZE,
+    pipelined: typing.Optional[bool] = None,
+):
+    """Feed the (offset, size) `extents` of a file into `hasher`, in order.
+
+    The file is opened once, and the data is read in `chunk_size` pieces into a
+    pair of preallocated buffers. When `pipelined` is true, the next chunk
+    (which may be in the next extent) is read by a background thread while the
+    current chunk is hashed (both reading and hashing release the GIL). By
+    default the pipeline is only used when there is more than one CPU available
+    to this process, as there is nothing to overlap with on a single core. If
+    the file ends early, only the data available is hashed. The hasher is
+    returned.
+    """
+    if pipelined is None:
+        pipelined = len(os.sched_getaffinity(0)) > 1
+    extents = [(offset, size) for offset, size in extents if size > 0]
+    buffers = (bytearray(chunk_size), bytearray(chunk_size))
+    fd = os.open(path, os.O_RDONLY)
+
+    def extent_end(extent_index: int) -> int:
+        extent_offset, extent_size = extents[extent_index]
+        return extent_offset + extent_size
+
+    def next_read(
+        extent_index: int,
+        position: int,
+    ) -> typing.Tuple[int, int]:
+        # Move on to the start of the next extent at the end of each one
+        while extent_index < len(extents) and \
+                position >= extent_end(extent_index):
+            extent_index += 1
+            if extent_index < len(extents):
+                position = extents[extent_index][0]
+        return extent_index, position
+
+    def read_chunk(index: int, position: int, end: int) -> int:
+        view = memoryview(buffers[index])[:min(chunk_size, end - position)]
+        length = os.preadv(fd, [view], position)
+        read_counter.add(length)
+        return length
+
+    try:
+        with contextlib.ExitStack() as stack:
+            if pipelined:
+                executor = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                )
+                submit = executor.submit
+            else:
+                # Run each read immediately, but keep the same interface.
+                def submit(function, *args):
+                    future = concurrent.futures.Future()
+                    future.set_result(function(*args))
+                    return future
+            index = 0
+            extent_index, position = next_read(
+                0,
+                extents[0][0] if extents else 0,
+            )
+            if extent_index < len(extents):
+                future = submit(
+                    read_chunk,
+                    index,
+                    position,
+                    extent_end(extent_index),
+                )
+            while extent_index < len(extents):
+                length = future.result()
+                if length == 0:
+                    log.warning(
+                        "%s ended at %#x, before the end of the image (%#x)",
+                        path,
+                        position,
+                        extent_end(extent_index),
+                    )
+                    break
+                extent_index, position = next_read(
+                    extent_index,
+                    position + length,
+                )
+                if extent_index < len(extents):
+                    future = submit(
+                        read_chunk,
+                        1 - index,
+                        position,
+                        extent_end(extent_index),
+                    )
+                hasher.update(memoryview(buffers[index])[:length])
+                watchdog.step()
+                index = 1 - index
+    finally:
+        os.close(fd)
+    return hasher
+
+
 @functools.total_ordering
 class ImageKind(enum.Enum):
 
@@ -367,6 +965,9 @@ class FirmwareImage(object):
     #: The size of the image.
     size: int
 
+    #: The name of the digest algorithm used when comparing this image.
+    digest_name: str
+
     @typing.overload
     def __init__(
         self,
@@ -374,6 +975,8 @@ class FirmwareImage(object):
         offset: int,
         kind: ImageKind,
         size: int,
+        *,
+        digest_name: str = DEFAULT_DIGEST,
     ): ...
 
     @typing.overload
@@ -381,6 +984,8 @@ class FirmwareImage(object):
         self,
         device: os.PathLike,
         kind: ImageKind,
+        *,
+        digest_name: str = DEFAULT_DIGEST,
     ): ...
 
     def __init__(self, *args, **kwargs):
@@ -388,8 +993,13 @@ class FirmwareImage(object):
 
         The source data for an image can either be a discrete file on a
         filesystem, or a range of bytes (defined as an offset and length) on a
-        raw block device.
+        raw block device. The digest algorithm used for comparisons can be
+        given with the `digest_name` keyword argument.
         """
+        self.digest_name = resolve_digest_name(
+            kwargs.pop("digest_name", DEFAULT_DIGEST)
+        )
+        self._digests: typing.Dict[str, str] = {}
         attr_names = ("device", "offset", "kind", "size")
         if len(args) == 4:
             for attr_name, arg in zip(attr_names, args):
@@ -411,18 +1021,44 @@ class FirmwareImage(object):
         else:
             raise ValueError()
 
-    @functools.cached_property
-    def hexdigest(self) -> str:
-        """A secure hash of the data for this firmware image.
+    def digest(self, digest_name: typing.Optional[str] = None) -> str:
+        """Hash the data for this firmware image.
 
-        Currently this is the SHA256 of the data.
+        If `digest_name` is not given, `self.digest_name` is used. Digests are
+        cached for each algorithm.
         """
-        with open(self.device, "rb") as device:
-            device.seek(self.offset)
-            hasher = hashlib.sha256(
-                device.read(self.size)
+        if digest_name is None:
+            digest_name = self.digest_name
+        if digest_name not in self._digests:
+            hasher = hash_extents(
+                self.device,
+                self.extents,
+                new_hasher(digest_name),
             )
-        return hasher.hexdigest()
+            self._digests[digest_name] = hasher.hexdigest()
+        return self._digests[digest_name]
+
+    @property
+    def extents(self) -> typing.List[typing.Tuple[int, int]]:
+        """The (offset, size) ranges on `device` holding the image data.
+
+        This is a single range, except for files on a filesystem that are
+        fragmented.
+        """
+        return [(self.offset, self.size)]
+
+    @property
+    def hexdigest(self) -> str:
+        """A hash of the data for this firmware image.
+
+        The algorithm used is the one named by `digest_name`.
+        """
+        return self.digest()
+
+    @property
+    def tagged_digest(self) -> str:
+        """The `hexdigest`, prefixed with the name of the digest algorithm."""
+        return f"{self.digest_name}:{self.hexdigest}"
 
     @property
     def path(self):
@@ -436,10 +1072,11 @@ class FirmwareImage(object):
     def __eq__(self, other: FirmwareImage) -> bool:
         """Compare a firmware image to another firmware image.
 
-        Only the `hexdigest` of both objects are compared.
+        Only the digests of both objects are compared, using the digest
+        algorithm of this image.
         """
         if isinstance(other, FirmwareImage):
-            return self.hexdigest == other.hexdigest
+            return self.hexdigest == other.digest(self.digest_name)
         else:
             return NotImplemented
 
@@ -501,7 +1138,13 @@ class FirmwareImage(object):
             new_offset = new_offset.offset
         else:
             return NotImplemented
-        return type(self)(self.device, new_offset, self.kind, self.size)
+        return type(self)(
+            self.device,
+            new_offset,
+            self.kind,
+            self.size,
+            digest_name=self.digest_name,
+        )
 
     def __repr__(self):
         # defining repr so that the size and offset are in hex
@@ -528,176 +1171,2104 @@ for method_name in ("__lt__", "__le__", "__gt__", "__ge__"):
     method.__doc__ = _firmware_image_comparison_docstring
 
 
-def find_images(device_path: os.PathLike) -> typing.Collection[FirmwareImage]:
-    """Find firmware images on a raw block device."""
-    images = []
-    image_finders = (
-        get_mlo_toc_size,
-        get_u_boot_legacy_size,
-        get_u_boot_fit_size
-    )
-    with open(device_path, "rb") as device:
-        for offset in (0, 0x20000, 0x40000, 0x60000):
-            for get_size in image_finders:
-                device.seek(offset)
-                try:
-                    image_size = get_size(device)
-                except InvalidFirmwareImage as exc:
-                    # Just log these exceptions, they're expected
-                    log.debug("%s", exc)
-                else:
-                    if get_size is get_mlo_toc_size:
-                        image_kind = ImageKind.MLO
-                    else:
-                        image_kind = ImageKind.UBOOT
-                    images.append(FirmwareImage(
-                        device_path,
-                        offset,
-                        image_kind,
-                        image_size
-                    ))
-    return images
+#: The size of the blocks digests are taken of in an `ImageManifest`.
+MANIFEST_BLOCK_SIZE = 4096
 
 
-def compare_images(
-    new_mlo: FirmwareImage,
-    new_u_boot: FirmwareImage,
-    device_paths: typing.Iterable[os.PathLike],
-) -> typing.Sequence[FirmwareImage]:
-    """Update BeagleBone Black/Green firmware.
+def hash_blocks(
+    path: os.PathLike,
+    offset: int,
+    size: int,
+    digest_name: str,
+    block_size: int = MANIFEST_BLOCK_SIZE,
+) -> typing.List[str]:
+    """Hash each `block_size` block of a byte range of a file.
 
-    This handles both raw and FAT bootloader configurations (see section
-    26.1.8.5 of the AM335x Reference Manual for more details).
+    The last block may be shorter than `block_size`. If the file ends before
+    the end of the range, only the blocks that could be read are returned.
     """
-    # There are two possible MMC/SD devices on BeagleBones, mmcblk0 and 1, and
-    # four possible locations for the MLO: 0, 0x20000, 0x40000, and 0x60000.
-    # The full U-Boot image is then (possibly) at one of the later loader
-    # locations.
-    images_to_update = []
-    for device_path in device_paths:
-        sector_size = get_block_size(device_path)
-        log.debug("Using %d-byte sectors for %s", sector_size, device_path)
-        with open(device_path, "rb") as device:
-            lowest_partition_start = find_mbr_first_partition(
-                device, sector_size
-            )
-            # Just not handling the case where there's no MBR
-            if lowest_partition_start is None:
-                log.info(
-                    "No MBR found on device '%s', skipping.",
-                    device_path
-                )
-                continue
-        images = find_images(device_path)
-        if not images:
-            log.debug("No firmware images found on device '%s'", device_path)
-        for image in images:
-            if image.offset == 0:
-                # This error should not be hit
-                log.error("%s would overlap the MBR", image)
-                continue
-            # "shift" the new image to the offset of the old image
-            if image.kind is ImageKind.MLO:
-                new_image = new_mlo
-            elif image.kind is ImageKind.UBOOT:
-                new_image = new_u_boot
-            else:
-                raise ValueError("Unknown image kind %s", image.kind)
-            if new_image @ image >= lowest_partition_start:
-                log.error(
-                    "%s would overlap the partition starting at %#x",
-                    image
-                )
-                continue
-            # The equality operation *only* checks the sha256 hash of the data
-            if new_image != image:
-                log.info(
-                    (
-                        "New %(kind)s (%(path)s) does not match existing "
-                        "%(kind)s on %(device_name)s at offset %(offset)#x"
-                    ),
-                    {
-                        "kind": image.kind.value,
-                        "path": new_image.path,
-                        "device_name": device_path,
-                        "offset": image.offset,
-                    }
-                )
-                log.debug(
-                    "%-20s: %s",
-                    "New image hash",
-                    new_image.hexdigest
-                )
-                log.debug(
-                    "%-20s: %s",
-                    "Existing image hash",
-                    image.hexdigest
-                )
-                images_to_update.append(image)
-    return images_to_update
+    block_digests = []
+    with open_for_reading(path) as source:
+        source.seek(offset)
+        remaining = size
+        while remaining > 0:
+            block = source.read(min(block_size, remaining))
+            if not block:
+                break
+            block_digests.append(new_hasher(digest_name, block).hexdigest())
+            remaining -= len(block)
+            watchdog.step()
+    return block_digests
 
 
-def copy_raw(
-    source_image: FirmwareImage,
-    target_image: FirmwareImage,
+def merkle_root(digest_name: str, block_digests: typing.Sequence[str]) -> str:
+    """Combine a list of block digests into a single digest.
+
+    Pairs of digests are concatenated and hashed until only one digest is left.
+    When there's an odd number of digests at a level, the last one is moved up
+    to the next level unchanged.
+    """
+    level = [bytes.fromhex(block_digest) for block_digest in block_digests]
+    if not level:
+        return new_hasher(digest_name).hexdigest()
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level) - 1, 2):
+            hasher = new_hasher(digest_name, level[i] + level[i + 1])
+            next_level.append(bytes.fromhex(hasher.hexdigest()))
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+class ImageManifest(object):
+    """Per-block digests of an image.
+
+    Manifests for the source images are stored next to them (see
+    `load_or_generate`), so that device images can be compared against them
+    without reading the source images again, and so that the blocks that
+    differ can be pointed out.
+    """
+
+    #: Added to the path of an image to get the path of its manifest.
+    SUFFIX = ".manifest"
+
+    #: The version of the manifest file format.
+    VERSION = 1
+
+    #: The name of the digest algorithm used for the block digests.
+    digest_name: str
+
+    #: The size of each block (the last block may be shorter).
+    block_size: int
+
+    #: The size of the image the manifest is for.
+    size: int
+
+    #: The modification time of the image when the manifest was generated, in
+    #: nanoseconds. Used to detect stale manifests.
+    mtime_ns: int
+
+    #: The digest of every block of the image.
+    block_digests: typing.List[str]
+
+    def __init__(
+        self,
+        digest_name: str,
+        block_size: int,
+        size: int,
+        mtime_ns: int,
+        block_digests: typing.List[str],
+    ):
+        self.digest_name = digest_name
+        self.block_size = block_size
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.block_digests = block_digests
+
+    @classmethod
+    def generate(
+        cls,
+        image: FirmwareImage,
+        block_size: int = MANIFEST_BLOCK_SIZE,
+    ) -> ImageManifest:
+        """Create a manifest for an image, using its digest algorithm."""
+        return cls(
+            image.digest_name,
+            block_size,
+            image.size,
+            os.stat(image.path).st_mtime_ns,
+            hash_blocks(
+                image.path,
+                image.offset,
+                image.size,
+                image.digest_name,
+                block_size,
+            ),
+        )
+
+    @classmethod
+    def manifest_path(cls, image: FirmwareImage) -> str:
+        """The path a manifest for `image` is stored at."""
+        return f"{os.fsdecode(image.path)}{cls.SUFFIX}"
+
+    @classmethod
+    def load_or_generate(
+        cls,
+        image: FirmwareImage,
+        block_size: int = MANIFEST_BLOCK_SIZE,
+    ) -> ImageManifest:
+        """Load the manifest for a source image, creating it if needed.
+
+        A stored manifest is only used if it matches the current size and
+        modification time of the image, and uses the same digest algorithm and
+        block size. Otherwise a new manifest is generated and saved. Failures to
+        save it are logged, and the new manifest is returned anyway.
+        """
+        path = cls.manifest_path(image)
+        try:
+            with open(path, "r") as manifest_file:
+                manifest = cls.from_dict(json.load(manifest_file))
+        except FileNotFoundError:
+            log.debug("No manifest found at '%s'", path)
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            log.warning("Ignoring invalid manifest '%s': %s", path, exc)
+        else:
+            stat = os.stat(image.path)
+            if (
+                manifest.digest_name == image.digest_name
+                and manifest.block_size == block_size
+                and manifest.size == stat.st_size == image.size
+                and manifest.mtime_ns == stat.st_mtime_ns
+            ):
+                log.debug("Using manifest '%s'", path)
+                return manifest
+            log.info("Manifest '%s' is out of date, regenerating it", path)
+        manifest = cls.generate(image, block_size)
+        try:
+            write_atomically(path, json.dumps(manifest.to_dict(), indent=1))
+        except OSError as exc:
+            log.warning("Unable to save manifest '%s': %s", path, exc)
+        return manifest
+
+    @classmethod
+    def from_dict(cls, data: typing.Mapping[str, typing.Any]) -> ImageManifest:
+        """Create a manifest from the output of `to_dict`.
+
+        `ValueError` is raised if the data is not valid.
+        """
+        if data["version"] != cls.VERSION:
+            raise ValueError(f"Unsupported manifest version {data['version']}")
+        manifest = cls(
+            resolve_digest_name(data["digest"]),
+            int(data["block_size"]),
+            int(data["size"]),
+            int(data["mtime_ns"]),
+            list(data["blocks"]),
+        )
+        if manifest.root != data["root"]:
+            raise ValueError("The root digest does not match the blocks")
+        return manifest
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """Convert the manifest to a JSON-compatible dictionary."""
+        return {
+            "version": self.VERSION,
+            "digest": self.digest_name,
+            "block_size": self.block_size,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "root": self.root,
+            "blocks": self.block_digests,
+        }
+
+    @functools.cached_property
+    def root(self) -> str:
+        """The Merkle root of the block digests."""
+        return merkle_root(self.digest_name, self.block_digests)
+
+    @property
+    def tagged_root(self) -> str:
+        """The `root`, prefixed with the name of the digest algorithm."""
+        return f"{self.digest_name}:{self.root}"
+
+    def measure(self, target_image: FirmwareImage) -> ImageManifest:
+        """Create a manifest for the same byte range on another device.
+
+        The range starts at the offset of `target_image`, and is as long as the
+        image this manifest is for. The same digest algorithm and block size
+        are used, so the two manifests can be compared with `diff`.
+        """
+        return type(self)(
+            self.digest_name,
+            self.block_size,
+            self.size,
+            0,
+            hash_blocks(
+                target_image.device,
+                target_image.offset,
+                self.size,
+                self.digest_name,
+                self.block_size,
+            ),
+        )
+
+    def diff(self, other: ImageManifest) -> typing.List[int]:
+        """List the indices of blocks that differ between two manifests.
+
+        Blocks missing from either manifest count as different.
+        """
+        if (self.digest_name, self.block_size) != (
+            other.digest_name,
+            other.block_size,
+        ):
+            raise ValueError(
+                "Manifests with different digests or block sizes cannot be "
+                "compared"
+            )
+        if self.root == other.root and self.size == other.size:
+            return []
+        block_count = max(len(self.block_digests), len(other.block_digests))
+        return [
+            i for i in range(block_count)
+            if i >= len(self.block_digests)
+            or i >= len(other.block_digests)
+            or self.block_digests[i] != other.block_digests[i]
+        ]
+
+
+class WriteVerificationError(Exception):
+    """Raised when data read back after a write does not match the source."""
+    pass
+
+
+def format_block_ranges(blocks: typing.Sequence[int]) -> str:
+    """Format a sorted list of block indices as ranges, like "0-3, 7"."""
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][1] == block - 1:
+            ranges[-1][1] = block
+        else:
+            ranges.append([block, block])
+    return ", ".join(
+        str(first) if first == last else f"{first}-{last}"
+        for first, last in ranges
+    )
+
+
+class ImageFormat(typing.NamedTuple):
+    """A kind of firmware image that can be found on a device."""
+
+    #: A short, human readable name for the format.
+    name: str
+
+    #: The bytes every image of this format starts with.
+    magic: bytes
+
+    #: What kind of image this format holds.
+    kind: ImageKind
+
+    #: A function that determines the size of an image at the current position
+    #: of a stream (see `get_mlo_toc_size` for an example).
+    get_size: typing.Callable[[io.BinaryIO], int]
+
+    #: An optional coroutine function version of `get_size`, taking a stream
+    #: and an executor. Formats without one have `get_size` run in an executor
+    #: by the async API.
+    get_size_async: typing.Optional[
+        typing.Callable[..., typing.Awaitable[int]]
+    ] = None
+
+
+#: The image formats that `find_images` will look for.
+IMAGE_FORMATS: typing.List[ImageFormat] = []
+
+
+def register_image_format(
+    name: str,
+    magic: bytes,
+    kind: ImageKind,
+    get_size: typing.Callable[[io.BinaryIO], int],
+    get_size_async: typing.Optional[
+        typing.Callable[..., typing.Awaitable[int]]
+    ] = None,
+) -> ImageFormat:
+    """Add a new image format for `find_images` to look for.
+
+    `get_size` is only called when the data at an offset starts with `magic`,
+    so adding formats does not slow down probing for the other formats.
+    `get_size_async` only needs to be given if `get_size` does more than just
+    read the stream, like running a subprocess.
+    """
+    if not magic:
+        raise ValueError(f"The magic bytes for {name} cannot be empty")
+    image_format = ImageFormat(name, magic, kind, get_size, get_size_async)
+    IMAGE_FORMATS.append(image_format)
+    return image_format
+
+
+register_image_format(
+    "MLO",
+    # The first TOC item is enough to pick out MLO images, get_mlo_toc_size()
+    # checks the rest of the TOC.
+    MLO_TOC[:32],
+    ImageKind.MLO,
+    get_mlo_toc_size,
+)
+register_image_format(
+    "U-Boot legacy",
+    struct.pack(">I", 0x27051956),
+    ImageKind.UBOOT,
+    get_u_boot_legacy_size,
+)
+register_image_format(
+    "U-Boot FIT",
+    struct.pack(">I", 0xd00dfeed),
+    ImageKind.UBOOT,
+    get_u_boot_fit_size,
+    get_u_boot_fit_size_async,
+)
+
+
+def match_image_format(stream: io.BinaryIO) -> typing.Optional[ImageFormat]:
+    """Find the format with its magic bytes at the current position of a stream.
+
+    The first few bytes are read once and matched against the magic bytes of
+    every registered format. The stream is left where it started. If nothing
+    matches, `None` is returned.
+    """
+    starting_offset = stream.tell()
+    peek_len = max(len(f.magic) for f in IMAGE_FORMATS)
+    prefix = stream.read(peek_len)
+    stream.seek(starting_offset, os.SEEK_SET)
+    for image_format in IMAGE_FORMATS:
+        if prefix.startswith(image_format.magic):
+            return image_format
+    return None
+
+
+def probe_image(
+    stream: io.BinaryIO,
+) -> typing.Optional[typing.Tuple[ImageFormat, int]]:
+    """Identify the image at the current position of a stream.
+
+    If a format matches (see `match_image_format`), its parser is run and the
+    format and image size are returned. If nothing matches, `None` is returned.
+    If a format matched but the image is invalid, the `InvalidFirmwareImage`
+    from the parser is propagated.
+    """
+    image_format = match_image_format(stream)
+    if image_format is None:
+        return None
+    return image_format, image_format.get_size(stream)
+
+
+#: The offsets the AM335x boot ROM looks for MLO images at on MMC/SD devices.
+RAW_BOOT_OFFSETS = (0, 0x20000, 0x40000, 0x60000)
+
+#: How much data is read at a time when scanning for images.
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+
+def find_image_candidates(
+    device: io.BinaryIO,
+    scan_range: typing.Tuple[int, int],
+    alignment: int,
+    chunk_size: int = SCAN_CHUNK_SIZE,
+) -> typing.Set[int]:
+    """Find every offset in a range that starts with a known magic number.
+
+    The range is read in chunks of `chunk_size` bytes, and each chunk is
+    searched for the magic bytes of every registered `ImageFormat`. Only
+    offsets that are a multiple of `alignment` are returned. The returned
+    offsets are only candidates, they still need to be checked with
+    `probe_image`.
+    """
+    magics = {image_format.magic for image_format in IMAGE_FORMATS}
+    # Keep enough of the previous chunk around to find magic numbers that
+    # straddle two chunks.
+    overlap = max(len(magic) for magic in magics) - 1
+    start, end = scan_range
+    candidates = set()
+    tail = b""
+    chunk_start = start
+    device.seek(start)
+    while chunk_start < end:
+        chunk = device.read(min(chunk_size, end - chunk_start))
+        if not chunk:
+            break
+        buf = tail + chunk
+        buf_start = chunk_start - len(tail)
+        for magic in magics:
+            index = buf.find(magic)
+            while index != -1:
+                if (buf_start + index) % alignment == 0:
+                    candidates.add(buf_start + index)
+                index = buf.find(magic, index + 1)
+        tail = buf[len(buf) - overlap:]
+        chunk_start += len(chunk)
+        watchdog.step()
+    log.debug(
+        "Found %d candidate offsets between %#x and %#x",
+        len(candidates),
+        start,
+        end,
+    )
+    return candidates
+
+
+def image_offsets(
+    device: io.BinaryIO,
+    device_path: os.PathLike,
+    scan_range: typing.Optional[typing.Tuple[int, int]] = None,
+) -> typing.List[int]:
+    """List the offsets on a device to look for images at, in order.
+
+    See `find_images` for the meaning of `scan_range`.
+    """
+    offsets = set(RAW_BOOT_OFFSETS)
+    if scan_range is not None:
+        offsets.update(find_image_candidates(
+            device,
+            scan_range,
+            get_block_size(device_path),
+        ))
+    return sorted(offsets)
+
+
+def find_images(
+    device_path: os.PathLike,
+    digest_name: str = DEFAULT_DIGEST,
+    scan_range: typing.Optional[typing.Tuple[int, int]] = None,
+) -> typing.Collection[FirmwareImage]:
+    """Find firmware images on a raw block device.
+
+    Images are looked for at the `RAW_BOOT_OFFSETS`. If `scan_range` is given,
+    every sector in that range is also searched for images (see
+    `find_image_candidates`). The images found will use `digest_name` for
+    comparisons.
+    """
+    images: typing.List[FirmwareImage] = []
+    with open_for_reading(device_path) as device:
+        for offset in image_offsets(device, device_path, scan_range):
+            probe_for_image(images, device, device_path, offset, digest_name)
+    return images
+
+
+def probe_for_image(
+    images: typing.List[FirmwareImage],
+    device: io.BinaryIO,
+    device_path: os.PathLike,
+    offset: int,
+    digest_name: str = DEFAULT_DIGEST,
 ):
-    """Copy the contents of one image over another image."""
-    with open(source_image.device, "rb") as source:
+    """Check for an image at `offset`, adding it to `images` if there is one.
+
+    This is a single step of `find_images`, for an offset from `image_offsets`.
+    `images` are the images found so far on the device.
+    """
+    # Images can't start inside of other images. This also skips anything
+    # embedded inside an image, like the FDT in U-Boot.
+    if images and images[-1] > offset:
+        return
+    device.seek(offset)
+    try:
+        probed = probe_image(device)
+    except InvalidFirmwareImage as exc:
+        # Just log these exceptions, the magic number can match data that isn't
+        # actually an image.
+        log.debug("%s", exc)
+        return
+    if probed is None:
+        return
+    image_format, image_size = probed
+    log.debug(
+        "Found %s image at %#x on %s",
+        image_format.name,
+        offset,
+        device_path,
+    )
+    images.append(FirmwareImage(
+        device_path,
+        offset,
+        image_format.kind,
+        image_size,
+        digest_name=digest_name,
+    ))
+
+
+class InvalidFatVolume(Exception):
+    """The first partition does not hold a FAT filesystem that can be read."""
+    pass
+
+
+class FatDirEntry(typing.NamedTuple):
+    """A file in the root directory of a FAT filesystem."""
+
+    #: The 8.3 name of the file, like "U-BOOT.IMG".
+    name: str
+
+    #: The first cluster of the file's data (0 for an empty file).
+    first_cluster: int
+
+    #: The size of the file in bytes.
+    size: int
+
+    #: The offset of the 32-byte directory entry on the device.
+    entry_offset: int
+
+
+class FatVolume(object):
+    """A minimal, read-only view of a FAT12/16/32 filesystem.
+
+    Only the boot sector, the root directory and the FAT entries for the
+    clusters that are asked for are read, so nothing needs to be mounted.
+    Subdirectories and long file names are not supported (the AM335x boot ROM
+    only looks for MLO in the root directory by its 8.3 name).
+    """
+
+    #: The device the filesystem is on.
+    device: os.PathLike
+
+    #: The offset of the start of the filesystem on the device.
+    offset: int
+
+    #: The size of a logical sector in bytes.
+    bytes_per_sector: int
+
+    #: The number of sectors in a cluster.
+    sectors_per_cluster: int
+
+    #: The number of sectors before the first FAT.
+    reserved_sectors: int
+
+    #: The number of copies of the FAT.
+    fat_count: int
+
+    #: The size of each FAT in sectors.
+    fat_sectors: int
+
+    #: The number of entries in a FAT12/16 root directory (0 for FAT32).
+    root_entry_count: int
+
+    #: The first cluster of a FAT32 root directory (0 for FAT12/16).
+    root_cluster: int
+
+    #: The number of data clusters.
+    cluster_count: int
+
+    #: The size of FAT entries in bits (12, 16 or 32).
+    fat_bits: int
+
+    def __init__(self, device: os.PathLike, offset: int):
+        """Read the boot sector of the filesystem at `offset` on `device`.
+
+        `InvalidFatVolume` is raised if there isn't a FAT filesystem there.
+        """
+        self.device = device
+        self.offset = offset
+        with open_for_reading(device) as stream:
+            stream.seek(offset)
+            boot_sector = stream.read(DEFAULT_SECTOR_SIZE)
+        if len(boot_sector) != DEFAULT_SECTOR_SIZE:
+            raise InvalidFatVolume(f"Boot sector at {offset:#x} is truncated")
+        if boot_sector[0x1fe:0x200] != b"\x55\xaa":
+            raise InvalidFatVolume(f"No boot sector signature at {offset:#x}")
+        # The BIOS Parameter Block, up to the end of the common fields. The
+        # OEM name, media descriptor and CHS geometry are skipped.
+        (
+            self.bytes_per_sector,
+            self.sectors_per_cluster,
+            self.reserved_sectors,
+            self.fat_count,
+            self.root_entry_count,
+            total_sectors,
+            self.fat_sectors,
+            total_sectors_32,
+        ) = struct.unpack_from("<HBHBHH1xH8xI", boot_sector, 0x0b)
+        if self.bytes_per_sector not in (512, 1024, 2048, 4096):
+            raise InvalidFatVolume(
+                f"Invalid sector size ({self.bytes_per_sector}) at {offset:#x}"
+            )
+        spc = self.sectors_per_cluster
+        if spc == 0 or spc & (spc - 1):
+            raise InvalidFatVolume(
+                f"Invalid sectors per cluster ({spc}) at {offset:#x}"
+            )
+        if self.reserved_sectors == 0 or self.fat_count == 0:
+            raise InvalidFatVolume(f"Invalid FAT layout at {offset:#x}")
+        if total_sectors == 0:
+            total_sectors = total_sectors_32
+        self.root_cluster = 0
+        if self.fat_sectors == 0:
+            # FAT32 moves the FAT size into an extended BPB
+            self.fat_sectors, self.root_cluster = struct.unpack_from(
+                "<I4xI",
+                boot_sector,
+                0x24,
+            )
+        root_dir_sectors = math.ceil(
+            self.root_entry_count * 32 / self.bytes_per_sector
+        )
+        data_sectors = total_sectors - (
+            self.reserved_sectors
+            + self.fat_count * self.fat_sectors
+            + root_dir_sectors
+        )
+        if self.fat_sectors == 0 or data_sectors <= 0:
+            raise InvalidFatVolume(f"Invalid FAT layout at {offset:#x}")
+        self.cluster_count = data_sectors // spc
+        # The FAT type is determined only by the number of clusters, per the
+        # Microsoft specification.
+        if self.cluster_count < 4085:
+            self.fat_bits = 12
+        elif self.cluster_count < 65525:
+            self.fat_bits = 16
+        else:
+            self.fat_bits = 32
+        if (self.fat_bits == 32) != (self.root_entry_count == 0):
+            raise InvalidFatVolume(
+                f"FAT{self.fat_bits} root directory layout is invalid at "
+                f"{offset:#x}"
+            )
+        log.debug(
+            "Found FAT%d filesystem at %#x on %s (%d-byte clusters)",
+            self.fat_bits,
+            offset,
+            device,
+            self.cluster_size,
+        )
+
+    @property
+    def cluster_size(self) -> int:
+        """The size of a cluster in bytes."""
+        return self.bytes_per_sector * self.sectors_per_cluster
+
+    @property
+    def fat_offset(self) -> int:
+        """The offset of the first FAT on the device."""
+        return self.offset + self.reserved_sectors * self.bytes_per_sector
+
+    @property
+    def root_dir_offset(self) -> int:
+        """The offset of a FAT12/16 root directory on the device."""
+        return self.fat_offset + (
+            self.fat_count * self.fat_sectors * self.bytes_per_sector
+        )
+
+    @property
+    def data_offset(self) -> int:
+        """The offset of the first data cluster (cluster 2) on the device."""
+        return self.root_dir_offset + align_up(
+            self.root_entry_count * 32,
+            self.bytes_per_sector,
+        )
+
+    def cluster_offset(self, cluster: int) -> int:
+        """The offset of a data cluster on the device."""
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def _is_data_cluster(self, cluster: int) -> bool:
+        return 2 <= cluster < self.cluster_count + 2
+
+    def _read(self, stream: io.BinaryIO, offset: int, size: int) -> bytes:
+        """Read exactly `size` bytes, raising `InvalidFatVolume` if it can't."""
+        stream.seek(offset)
+        data = stream.read(size)
+        if len(data) != size:
+            raise InvalidFatVolume(
+                f"{self.device} ended at {offset + len(data):#x}, inside the "
+                f"FAT filesystem at {self.offset:#x}"
+            )
+        return data
+
+    def _read_fat_entry(self, stream: io.BinaryIO, cluster: int) -> int:
+        if self.fat_bits == 12:
+            # FAT12 entries are packed, two entries to three bytes
+            data = self._read(stream, self.fat_offset + cluster * 3 // 2, 2)
+            (value,) = struct.unpack("<H", data)
+            return value >> 4 if cluster & 1 else value & 0xfff
+        elif self.fat_bits == 16:
+            data = self._read(stream, self.fat_offset + cluster * 2, 2)
+            (value,) = struct.unpack("<H", data)
+            return value
+        else:
+            data = self._read(stream, self.fat_offset + cluster * 4, 4)
+            (value,) = struct.unpack("<I", data)
+            # The top four bits of FAT32 entries are reserved
+            return value & 0x0fffffff
+
+    def cluster_chain(
+        self,
+        stream: io.BinaryIO,
+        first_cluster: int,
+    ) -> typing.List[int]:
+        """Follow the chain of clusters starting at `first_cluster`.
+
+        `InvalidFatVolume` is raised if the chain runs into a free, bad or out
+        of range cluster, or loops back on itself.
+        """
+        chain = []
+        seen = set()
+        cluster = first_cluster
+        # Anything past the last data cluster is either the end of chain
+        # marker, or a bad cluster (which is checked for below).
+        end_of_chain = (1 << self.fat_bits) - 8
+        if self.fat_bits == 32:
+            end_of_chain = 0x0ffffff8
+        while cluster < end_of_chain:
+            if not self._is_data_cluster(cluster) or cluster in seen:
+                raise InvalidFatVolume(
+                    f"Invalid cluster chain starting at {first_cluster} on "
+                    f"{self.device}"
+                )
+            chain.append(cluster)
+            seen.add(cluster)
+            cluster = self._read_fat_entry(stream, cluster)
+        return chain
+
+    def _read_dir_clusters(
+        self,
+        stream: io.BinaryIO,
+    ) -> typing.Iterator[typing.Tuple[int, bytes]]:
+        """Yield the offset and contents of each part of the root directory."""
+        if self.fat_bits != 32:
+            yield self.root_dir_offset, self._read(
+                stream,
+                self.root_dir_offset,
+                self.root_entry_count * 32,
+            )
+            return
+        for cluster in self.cluster_chain(stream, self.root_cluster):
+            cluster_offset = self.cluster_offset(cluster)
+            yield cluster_offset, self._read(
+                stream,
+                cluster_offset,
+                self.cluster_size,
+            )
+
+    def root_entries(self) -> typing.Iterator[FatDirEntry]:
+        """List the regular files in the root directory."""
+        DELETED_ENTRY = 0xe5
+        # Read-only, hidden, system and archive are fine, but long file name
+        # parts, volume labels and directories are skipped.
+        SKIPPED_ATTRIBUTES = 0x08 | 0x10
+        with open_for_reading(self.device) as stream:
+            for dir_offset, data in self._read_dir_clusters(stream):
+                for entry_offset in range(0, len(data) - 31, 32):
+                    (
+                        raw_name,
+                        attributes,
+                        cluster_high,
+                        cluster_low,
+                        size,
+                    ) = struct.unpack_from("<11sB8xH4xHI", data, entry_offset)
+                    # A leading NUL marks the end of the directory
+                    if raw_name[0] == 0:
+                        return
+                    if raw_name[0] == DELETED_ENTRY:
+                        continue
+                    if attributes & SKIPPED_ATTRIBUTES:
+                        continue
+                    base = raw_name[:8].rstrip(b" ")
+                    extension = raw_name[8:].rstrip(b" ")
+                    name = base + (b"." + extension if extension else b"")
+                    first_cluster = cluster_low
+                    if self.fat_bits == 32:
+                        first_cluster |= cluster_high << 16
+                    yield FatDirEntry(
+                        name.decode("ascii", "replace"),
+                        first_cluster,
+                        size,
+                        dir_offset + entry_offset,
+                    )
+
+    def find_file(self, name: str) -> typing.Optional[FatDirEntry]:
+        """Find a file in the root directory by its (case-insensitive) name."""
+        name = name.upper()
+        for entry in self.root_entries():
+            if entry.name.upper() == name:
+                return entry
+        return None
+
+    def extents(
+        self,
+        clusters: typing.Sequence[int],
+        size: int,
+    ) -> typing.List[typing.Tuple[int, int]]:
+        """Map the first `size` bytes of a cluster chain to device ranges.
+
+        Runs of consecutive clusters are merged, so an unfragmented file is a
+        single (offset, size) range.
+        """
+        extents: typing.List[typing.Tuple[int, int]] = []
+        remaining = size
+        previous_cluster = None
+        for cluster in clusters:
+            if remaining <= 0:
+                break
+            extent_size = min(self.cluster_size, remaining)
+            if previous_cluster is not None and cluster == previous_cluster + 1:
+                extent_offset, previous_size = extents[-1]
+                extents[-1] = (extent_offset, previous_size + extent_size)
+            else:
+                extents.append((self.cluster_offset(cluster), extent_size))
+            remaining -= extent_size
+            previous_cluster = cluster
+        return extents
+
+
+class FatFileImage(FirmwareImage):
+    """A firmware image stored as a file on a FAT filesystem.
+
+    The `offset` is that of the first cluster of the file, but the data may be
+    spread over several `extents`.
+    """
+
+    #: The filesystem the file is on.
+    volume: FatVolume
+
+    #: The directory entry for the file.
+    entry: FatDirEntry
+
+    #: The clusters allocated to the file, in order.
+    clusters: typing.List[int]
+
+    def __init__(
+        self,
+        volume: FatVolume,
+        entry: FatDirEntry,
+        clusters: typing.List[int],
+        kind: ImageKind,
+        *,
+        digest_name: str = DEFAULT_DIGEST,
+    ):
+        super().__init__(
+            volume.device,
+            volume.cluster_offset(clusters[0]),
+            kind,
+            entry.size,
+            digest_name=digest_name,
+        )
+        self.volume = volume
+        self.entry = entry
+        self.clusters = clusters
+
+    @property
+    def extents(self) -> typing.List[typing.Tuple[int, int]]:
+        return self.volume.extents(self.clusters, self.size)
+
+    def fits(self, new_image: FirmwareImage) -> bool:
+        """Check if `new_image` can be written over this file in place.
+
+        The new image has to use exactly the clusters already allocated to this
+        file, so that only the file data and the size in the directory entry
+        change, and the FATs are left alone.
+        """
+        cluster_size = self.volume.cluster_size
+        return math.ceil(new_image.size / cluster_size) == len(self.clusters)
+
+    def __matmul__(self, new_offset):
+        # Files can't be moved around by offset
+        return NotImplemented
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}('{self.device}', "
+            f"'{self.entry.name}', {self.offset:#x}, "
+            f"ImageKind.{self.kind.name}, {self.size:#x})"
+        )
+
+
+#: The names of the bootloader files on a FAT boot partition.
+FAT_IMAGE_NAMES = {
+    ImageKind.MLO: "MLO",
+    ImageKind.UBOOT: "u-boot.img",
+}
+
+
+def find_fat_images(
+    device_path: os.PathLike,
+    partition_start: int,
+    digest_name: str = DEFAULT_DIGEST,
+) -> typing.List[FatFileImage]:
+    """Find the bootloader files on a FAT partition.
+
+    If the partition at `partition_start` (usually found by
+    `find_mbr_first_partition`) is a FAT filesystem, the root directory is
+    searched for the `FAT_IMAGE_NAMES`. Missing or empty files are skipped, as
+    are partitions that aren't FAT. If the filesystem is damaged, a warning is
+    logged and no files are returned, so that a bad boot partition doesn't stop
+    the raw images from being checked.
+    """
+    try:
+        volume = FatVolume(device_path, partition_start)
+    except InvalidFatVolume as exc:
+        log.debug("%s", exc)
+        return []
+    images = []
+    try:
+        with open_for_reading(device_path) as stream:
+            for kind, file_name in FAT_IMAGE_NAMES.items():
+                entry = volume.find_file(file_name)
+                if entry is None or entry.size == 0:
+                    continue
+                clusters = volume.cluster_chain(stream, entry.first_cluster)
+                if len(clusters) * volume.cluster_size < entry.size:
+                    raise InvalidFatVolume(
+                        f"The cluster chain of {entry.name} is shorter than "
+                        "the file"
+                    )
+                images.append(FatFileImage(
+                    volume,
+                    entry,
+                    clusters,
+                    kind,
+                    digest_name=digest_name,
+                ))
+    except InvalidFatVolume as exc:
+        log.warning(
+            "Skipping the FAT partition at %#x on %s: %s",
+            partition_start,
+            device_path,
+            exc,
+        )
+        return []
+    for image in images:
+        log.debug(
+            "Found %s at %#x on %s (%d clusters)",
+            image.entry.name,
+            image.offset,
+            device_path,
+            len(image.clusters),
+        )
+    return images
+
+
+def find_mounted_partition(
+    device_path: os.PathLike,
+    partition_start: int,
+) -> typing.Optional[str]:
+    """Find where the partition at `partition_start` is mounted, if it is.
+
+    The partitions of `device_path` are looked up in sysfs, so this only finds
+    mounts of real block devices.
+    """
+    device_sysfs_path = os.path.realpath(get_sysfs_path(device_path))
+    try:
+        with open("/proc/mounts", "r") as mounts:
+            mount_lines = mounts.readlines()
+    except OSError as exc:
+        log.debug("Unable to read mounts: %s", exc)
+        return None
+    for line in mount_lines:
+        source, mount_point = line.split()[:2]
+        if not source.startswith("/dev/"):
+            continue
+        partition_name = os.path.basename(os.path.realpath(source))
+        partition_sysfs_path = os.path.realpath(
+            f"/sys/class/block/{partition_name}"
+        )
+        if os.path.dirname(partition_sysfs_path) != device_sysfs_path:
+            continue
+        try:
+            with open(os.path.join(partition_sysfs_path, "start")) as start:
+                # sysfs always uses 512-byte sectors
+                start_offset = int(start.read()) * 512
+        except (OSError, ValueError):
+            continue
+        if start_offset == partition_start:
+            # Spaces and such are escaped as octal in /proc/mounts
+            return mount_point.encode().decode("unicode_escape")
+    return None
+
+
+def copy_to_fat(
+    source_image: FirmwareImage,
+    target_image: FatFileImage,
+    source_data: typing.Optional[bytes] = None,
+) -> int:
+    """Overwrite a file on a FAT filesystem in place.
+
+    The new data is written over the clusters already allocated to the file
+    (see `FatFileImage.fits`), then the size in its directory entry is updated.
+    If the contents of `source_image` have already been read, they can be
+    given as `source_data`. The number of bytes written is returned.
+    """
+    if not target_image.fits(source_image):
+        raise ValueError(f"{source_image} does not fit in {target_image}")
+    if source_data is None:
+        source_data = read_image(source_image)
+    source_data = memoryview(source_data)
+    extents = target_image.volume.extents(
+        target_image.clusters,
+        source_image.size,
+    )
+    fd = os.open(target_image.device, os.O_WRONLY)
+    try:
+        os.set_blocking(fd, True)
+        data_offset = 0
+        write_size = 0
+        for extent_offset, extent_size in extents:
+            extent_data = source_data[data_offset:data_offset + extent_size]
+
+            def write_step(position: int, size: int) -> int:
+                step_size = os.pwrite(
+                    fd,
+                    extent_data[position:position + size],
+                    extent_offset + position,
+                )
+                if watchdog.enabled:
+                    # Flush each step so the final fsync() is short
+                    os.fdatasync(fd)
+                return step_size
+
+            written = watchdog.run_in_steps(
+                extent_size,
+                write_step,
+                f"Writing {target_image.entry.name} to "
+                f"{target_image.device}",
+            )
+            assert written == extent_size
+            data_offset += extent_size
+            write_size += extent_size
+        if source_image.size != target_image.entry.size:
+            # The file size is at the end of the directory entry
+            os.pwrite(
+                fd,
+                struct.pack("<I", source_image.size),
+                target_image.entry.entry_offset + 28,
+            )
+    except OSError:
+        # Same as in copy_raw(), this is just so there can be an else-clause
+        raise
+    else:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return write_size
+
+
+def write_atomically(path: os.PathLike, contents: str):
+    """Replace the contents of a file without ever leaving it partially written.
+
+    The contents are written to a hidden temporary file in the same directory,
+    which is then renamed over `path`.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory,
+        prefix=f".{name}.",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(contents)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def get_partition_gap(
+    device_path: os.PathLike,
+) -> typing.Optional[typing.Tuple[int, int]]:
+    """Find the range of bytes between the MBR and the first partition.
+
+    The returned tuple is the offset of the first byte after the MBR, and the
+    offset of the first partition. If there is no MBR, `None` is returned.
+    """
+    sector_size = get_block_size(device_path)
+    log.debug("Using %d-byte sectors for %s", sector_size, device_path)
+    with open_for_reading(device_path) as device:
+        lowest_partition_start = find_mbr_first_partition(device, sector_size)
+    if lowest_partition_start is None:
+        return None
+    return sector_size, lowest_partition_start
+
+
+class WritePlan(typing.NamedTuple):
+    """The byte range that will be written when replacing an image."""
+
+    #: The offset on the device the write starts at.
+    offset: int
+
+    #: The number of bytes that will be written.
+    size: int
+
+    #: The alignment (in bytes) of `offset` and `size`.
+    alignment: int
+
+
+def plan_write(
+    source_image: FirmwareImage,
+    target_image: FirmwareImage,
+) -> WritePlan:
+    """Plan an aligned write of `source_image` over `target_image`.
+
+    The write is expanded to the largest alignment from the device's
+    `EraseGeometry` where the expanded range stays between the MBR and the first
+    partition. This avoids the card having to read-modify-write partially
+    covered erase blocks. The padding is filled with the existing contents of
+    the device by `copy_raw`.
+    """
+    device_path = target_image.device
+    gap = get_partition_gap(device_path)
+    if gap is None:
+        # No MBR means there's no gap to pad within, so write the image as is.
+        plan = WritePlan(target_image.offset, source_image.size, 1)
+    else:
+        lower, upper = gap
+        image_end = target_image.offset + source_image.size
+        for alignment in get_erase_geometry(device_path).alignments():
+            start = align_down(target_image.offset, alignment)
+            end = align_up(image_end, alignment)
+            if start >= lower and end <= upper:
+                plan = WritePlan(start, end - start, alignment)
+                break
+        else:
+            plan = WritePlan(target_image.offset, source_image.size, 1)
+    log.info(
+        "Writing %#x-%#x on %s using %d-byte alignment",
+        plan.offset,
+        plan.offset + plan.size,
+        device_path,
+        plan.alignment,
+    )
+    return plan
+
+
+class UpdateMetrics(object):
+    """Measurements taken while checking and updating bootloaders.
+
+    These can be written out for the node_exporter textfile collector with
+    `write_textfile`.
+    """
+
+    #: The prefix used for every metric name.
+    PREFIX = "am335x_updater"
+
+    #: How long each phase of an update took, in seconds.
+    phase_durations: typing.Dict[str, float]
+
+    #: How long scanning each device took, in seconds.
+    scan_durations: typing.Dict[os.PathLike, float]
+
+
+    #: The number of bytes written to devices.
+    bytes_written: int
+
+    #: The number of outdated images, keyed by image kind and device.
+    outdated_images: typing.Dict[typing.Tuple[ImageKind, os.PathLike], int]
+
+    #: The writes made to each target image, keyed by device and offset.
+    target_writes: typing.Dict[typing.Tuple[os.PathLike, int], TargetWrite]
+
+    #: If the update finished with no outdated images remaining.
+    success: bool
+
+    def __init__(self):
+        self.phase_durations = {}
+        self.scan_durations = {}
+        self._bytes_read_base = read_counter.total
+        self.bytes_written = 0
+        self.outdated_images = {}
+        self.target_writes = {}
+        self.success = False
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _timed(durations: typing.Dict[typing.Any, float], key: typing.Any):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            durations[key] = durations.get(key, 0.0) + elapsed
+
+    def phase(self, name: str) -> typing.ContextManager[None]:
+        """Time a phase of the update (the time is added to any earlier)."""
+        return self._timed(self.phase_durations, name)
+
+    def device_scan(
+        self,
+        device_path: os.PathLike,
+    ) -> typing.ContextManager[None]:
+        """Time the scan of a device."""
+        return self._timed(self.scan_durations, device_path)
+
+    def add_outdated(self, image: FirmwareImage):
+        """Count an outdated image."""
+        key = (image.kind, image.device)
+        self.outdated_images[key] = self.outdated_images.get(key, 0) + 1
+
+    @property
+    def bytes_read(self) -> int:
+        """The bytes of device and image data read since this was created.
+
+        This counts every read made through `read_counter`, including scans,
+        probes, manifests and snapshots. It's shared by the whole process, so
+        it includes reads made for anything else running at the same time.
+        """
+        return read_counter.total - self._bytes_read_base
+
+    def add_target_write(self, result: TargetWrite):
+        """Record a write to a target image."""
+        self.target_writes[(result.image.device, result.image.offset)] = result
+        self.bytes_written += result.size
+
+    @staticmethod
+    def _labels(**labels: typing.Any) -> str:
+        escaped = (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"')
+            for value in labels.values()
+        )
+        pairs = ",".join(
+            f'{name}="{value}"' for name, value in zip(labels, escaped)
+        )
+        return "{" + pairs + "}"
+
+    def format(self, last_success: typing.Optional[float] = None) -> str:
+        """Format the metrics in the Prometheus text exposition format.
+
+        `last_success` is the timestamp of the last successful update, if this
+        update was not successful.
+        """
+        if self.success:
+            last_success = time.time()
+        lines = []
+
+        def metric(name, help_text, samples):
+            name = f"{self.PREFIX}_{name}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        metric(
+            "phase_duration_seconds",
+            "Time spent in each phase of the last run.",
+            (
+                (self._labels(phase=phase), duration)
+                for phase, duration in sorted(self.phase_durations.items())
+            ),
+        )
+        metric(
+            "scan_duration_seconds",
+            "Time spent scanning each device in the last run.",
+            (
+                (self._labels(device=device), duration)
+                for device, duration in sorted(self.scan_durations.items())
+            ),
+        )
+        metric(
+            "read_bytes",
+            "Bytes of device and image data read in the last run.",
+            (("", self.bytes_read),),
+        )
+        metric(
+            "written_bytes",
+            "Bytes written to devices in the last run.",
+            (("", self.bytes_written),),
+        )
+        target_labels = [
+            (
+                self._labels(
+                    kind=result.image.kind.name,
+                    device=device,
+                    offset=f"{offset:#x}",
+                ),
+                result,
+            )
+            for (device, offset), result in sorted(self.target_writes.items())
+        ]
+        metric(
+            "target_write_duration_seconds",
+            "Time spent writing each image in the last run.",
+            ((labels, result.elapsed) for labels, result in target_labels),
+        )
+        metric(
+            "target_written_bytes",
+            "Bytes written for each image in the last run.",
+            ((labels, result.size) for labels, result in target_labels),
+        )
+        # Report zeros for every scanned device so that the series don't
+        # disappear once a device is up to date.
+        outdated = {
+            (kind, device): 0
+            for kind in ImageKind
+            for device in self.scan_durations
+        }
+        outdated.update(self.outdated_images)
+        metric(
+            "outdated_images",
+            "Outdated images found in the last run.",
+            (
+                (self._labels(kind=kind.name, device=device), count)
+                for (kind, device), count in sorted(outdated.items())
+            ),
+        )
+        metric(
+            "last_run_success",
+            "1 if the last run left no outdated images, 0 otherwise.",
+            (("", int(self.success)),),
+        )
+        if last_success is not None:
+            metric(
+                "last_success_timestamp_seconds",
+                "Unix time of the last run that left no outdated images.",
+                (("", last_success),),
+            )
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def read_last_success(cls, path: os.PathLike) -> typing.Optional[float]:
+        """Read the last success timestamp from an existing metrics file."""
+        metric_name = f"{cls.PREFIX}_last_success_timestamp_seconds "
+        try:
+            with open(path, "r") as metrics_file:
+                for line in metrics_file:
+                    if line.startswith(metric_name):
+                        return float(line[len(metric_name):])
+        except (OSError, ValueError) as exc:
+            log.debug("Unable to read previous metrics: %s", exc)
+        return None
+
+    def write_textfile(self, path: os.PathLike):
+        """Atomically write the metrics to a file.
+
+        The metrics are written to a temporary file in the same directory, which
+        is then renamed over `path`, so the textfile collector never sees a
+        partial file. The last success timestamp is carried over from an
+        existing file if this update was not successful.
+        """
+        # The textfile collector only reads files ending in .prom, so the
+        # temporary file is ignored until it's renamed.
+        write_atomically(path, self.format(self.read_last_success(path)))
+
+
+def is_image_outdated(
+    image: FirmwareImage,
+    new_mlo: FirmwareImage,
+    new_u_boot: FirmwareImage,
+    lowest_partition_start: int,
+    manifests: typing.Mapping[ImageKind, ImageManifest],
+) -> bool:
+    """Check if an image found on a device should be replaced.
+
+    Images that would overlap the MBR or the first partition when replaced are
+    never reported as outdated. See `compare_images` for the other arguments.
+
+    Files on a FAT partition (`FatFileImage`) are always compared by digest, as
+    they aren't limited to the gap before the partition.
+    """
+    is_fat_file = isinstance(image, FatFileImage)
+    if image.offset == 0:
+        # This error should not be hit
+        log.error("%s would overlap the MBR", image)
+        return False
+    # "shift" the new image to the offset of the old image
+    if image.kind is ImageKind.MLO:
+        new_image = new_mlo
+    elif image.kind is ImageKind.UBOOT:
+        new_image = new_u_boot
+    else:
+        raise ValueError("Unknown image kind %s", image.kind)
+    if not is_fat_file and new_image @ image >= lowest_partition_start:
+        log.error(
+            "%s would overlap the partition starting at %#x",
+            image,
+            lowest_partition_start,
+        )
+        return False
+    manifest = None if is_fat_file else manifests.get(image.kind)
+    if manifest is not None:
+        # Compare the range the new image would be written to
+        target_manifest = manifest.measure(image)
+        differing_blocks = manifest.diff(target_manifest)
+        images_differ = bool(differing_blocks)
+    else:
+        # The equality operation *only* checks the digest of the data
+        images_differ = new_image != image
+    if images_differ:
+        log.info(
+            (
+                "New %(kind)s (%(path)s) does not match existing "
+                "%(kind)s on %(device_name)s at offset %(offset)#x"
+            ),
+            {
+                "kind": image.kind.value,
+                "path": new_image.path,
+                "device_name": image.device,
+                "offset": image.offset,
+            }
+        )
+        if manifest is not None:
+            log.debug(
+                "%-20s: %s",
+                "New image root",
+                manifest.tagged_root
+            )
+            log.debug(
+                "%-20s: %s",
+                "Existing image root",
+                target_manifest.tagged_root
+            )
+            log.info(
+                "%d-byte blocks that differ: %s",
+                manifest.block_size,
+                format_block_ranges(differing_blocks),
+            )
+        else:
+            log.debug(
+                "%-20s: %s",
+                "New image hash",
+                new_image.tagged_digest
+            )
+            log.debug(
+                "%-20s: %s",
+                "Existing image hash",
+                image.tagged_digest
+            )
+        return True
+    return False
+
+
+def compare_images(
+    new_mlo: FirmwareImage,
+    new_u_boot: FirmwareImage,
+    device_paths: typing.Iterable[os.PathLike],
+    metrics: typing.Optional[UpdateMetrics] = None,
+    full_scan: bool = False,
+    manifests: typing.Optional[
+        typing.Mapping[ImageKind, ImageManifest]
+    ] = None,
+) -> typing.Sequence[FirmwareImage]:
+    """Update BeagleBone Black/Green firmware.
+
+    This handles both raw and FAT bootloader configurations (see section
+    26.1.8.5 of the AM335x Reference Manual for more details). For FAT, the
+    files in the root directory of the first partition are read directly,
+    without mounting it.
+
+    If `metrics` is given, the time spent scanning each device is recorded in
+    it (reads are counted by `read_counter`). If `full_scan` is true, the entire
+    gap between the MBR and the first partition is searched for images, not
+    just the offsets the boot ROM checks.
+
+    When there is an `ImageManifest` in `manifests` for a kind of image, the
+    images on the devices are compared block by block against it instead of
+    hashing the source image.
+    """
+    if metrics is None:
+        metrics = UpdateMetrics()
+    if manifests is None:
+        manifests = {}
+    # There are two possible MMC/SD devices on BeagleBones, mmcblk0 and 1, and
+    # four possible locations for the MLO: 0, 0x20000, 0x40000, and 0x60000.
+    # The full U-Boot image is then (possibly) at one of the later loader
+    # locations.
+    images_to_update = []
+    for device_path in device_paths:
+        with metrics.device_scan(device_path):
+            gap = get_scan_gap(device_path)
+            if gap is None:
+                continue
+            lowest_partition_start = gap[1]
+            images = add_fat_images(
+                device_path,
+                find_images(
+                    device_path,
+                    new_mlo.digest_name,
+                    gap if full_scan else None,
+                ),
+                lowest_partition_start,
+                new_mlo.digest_name,
+            )
+            for image in images:
+                if is_image_outdated(
+                    image,
+                    new_mlo,
+                    new_u_boot,
+                    lowest_partition_start,
+                    manifests,
+                ):
+                    images_to_update.append(image)
+    return images_to_update
+
+
+def get_scan_gap(
+    device_path: os.PathLike,
+) -> typing.Optional[typing.Tuple[int, int]]:
+    """Start scanning a device, finding the gap before its first partition.
+
+    This is the first step of scanning a device in `compare_images`. `None` is
+    returned (and the device should be skipped) if there is no MBR.
+    """
+    watchdog.step(f"Scanning {device_path}")
+    gap = get_partition_gap(device_path)
+    # Just not handling the case where there's no MBR
+    if gap is None:
+        log.info("No MBR found on device '%s', skipping.", device_path)
+    return gap
+
+
+def add_fat_images(
+    device_path: os.PathLike,
+    raw_images: typing.Collection[FirmwareImage],
+    partition_start: int,
+    digest_name: str = DEFAULT_DIGEST,
+) -> typing.List[FirmwareImage]:
+    """Add any images on a FAT first partition to the raw images of a device.
+
+    This is the step of scanning a device in `compare_images` after the raw
+    images have been found. See `find_fat_images` for the other arguments.
+    """
+    images = list(raw_images)
+    images.extend(find_fat_images(device_path, partition_start, digest_name))
+    if not images:
+        log.debug("No firmware images found on device '%s'", device_path)
+    return images
+
+
+def read_image(image: FirmwareImage) -> bytes:
+    """Read all of the data for an image into memory."""
+    chunks = []
+    with open_for_reading(image.device) as source:
+        for extent_offset, extent_size in image.extents:
+            source.seek(extent_offset)
+            chunk = source.read(extent_size)
+            if len(chunk) != extent_size:
+                raise InvalidFirmwareImage(f"{image} is truncated")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def copy_raw(
+    source_image: FirmwareImage,
+    target_image: FirmwareImage,
+    plan: typing.Optional[WritePlan] = None,
+    source_data: typing.Optional[bytes] = None,
+) -> int:
+    """Copy the contents of one image over another image.
+
+    If a `WritePlan` is given, the planned range is written in aligned writes,
+    with the bytes around the image filled in with the current contents of the
+    device. When running under a systemd watchdog, the copy is split into steps
+    that are each written and flushed within the watchdog's step latency. If
+    the contents of `source_image` have already been read, they can be given as
+    `source_data`, and are written from memory instead of rereading the source.
+    The number of bytes written is returned.
+    """
+    if source_data is not None:
+        if plan is None:
+            plan = WritePlan(target_image.offset, source_image.size, 1)
+        return copy_planned(source_image, target_image, plan, source_data)
+    if plan is not None and plan.alignment > 1:
+        return copy_planned(source_image, target_image, plan)
+    with open_for_reading(source_image.device) as source:
         source.seek(source_image.offset)
         fd = os.open(target_image.device, os.O_WRONLY)
         try:
             os.set_blocking(fd, True)
             os.lseek(fd, target_image.offset, os.SEEK_SET)
-            # And now we rely on sendfile() aligning things properly
-            write_size = os.sendfile(
+
+            def copy_step(position: int, size: int) -> int:
+                # And now we rely on sendfile() aligning things properly
+                step_size = os.sendfile(fd, source.fileno(), None, size)
+                read_counter.add(step_size)
+                if watchdog.enabled:
+                    # Flush each step so the final fsync() is short
+                    os.fdatasync(fd)
+                return step_size
+
+            write_size = watchdog.run_in_steps(
+                source_image.size,
+                copy_step,
+                f"Writing {target_image.kind.value} to {target_image.device}",
+            )
+            assert write_size == source_image.size
+        except OSError:
+            # reraise it immediately; this except-clause is to satisfy the
+            # grammar so we can have an else-clause
+            raise
+        else:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return write_size
+
+
+class MainAction(enum.Enum):
+    """The type of action to perform when invoked as a command."""
+
+    #: Log which changes would be made, but don't change anything.
+    DRY_RUN = enum.auto()
+
+    #: Interactively confirm each change before making it.
+    INTERACTIVE = enum.auto()
+
+    #: Make all changes without prompting for confirmation.
+    FORCE = enum.auto()
+
+
+def copy_planned(
+    source_image: FirmwareImage,
+    target_image: FirmwareImage,
+    plan: WritePlan,
+    source_data: typing.Optional[bytes] = None,
+) -> int:
+    """Copy an image over another image using an aligned `WritePlan`.
+
+    `source_data` is the already read contents of `source_image`, if there are
+    any.
+    """
+    image_start = target_image.offset - plan.offset
+    image_end = image_start + source_image.size
+    if image_start < 0 or image_end > plan.size:
+        raise ValueError(f"{plan} does not cover {target_image}")
+    if source_data is None:
+        source_data = read_image(source_image)
+    fd = os.open(target_image.device, os.O_RDWR)
+    try:
+        os.set_blocking(fd, True)
+        if image_start == 0 and image_end == plan.size:
+            # There's no padding to fill in, so the (possibly shared) source
+            # data can be written as is.
+            view = memoryview(source_data)
+        else:
+            buf = bytearray(os.pread(fd, plan.size, plan.offset))
+            read_counter.add(len(buf))
+            assert len(buf) == plan.size
+            buf[image_start:image_end] = source_data
+            view = memoryview(buf)
+
+        def write_step(position: int, size: int) -> int:
+            step_size = os.pwrite(
+                fd,
+                view[position:position + size],
+                plan.offset + position,
+            )
+            if watchdog.enabled:
+                # Flush each step so the final fsync() is short
+                os.fdatasync(fd)
+            return step_size
+
+        write_size = watchdog.run_in_steps(
+            plan.size,
+            write_step,
+            f"Writing {target_image.kind.value} to {target_image.device}",
+            plan.alignment,
+        )
+        assert write_size == plan.size
+    except OSError:
+        # Same as in copy_raw(), this is just so there can be an else-clause
+        raise
+    else:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return write_size
+
+
+def verify_write(manifest: ImageManifest, target_image: FirmwareImage):
+    """Check that a newly written image matches the manifest of its source.
+
+    The written data is read back from the device, and
+    `WriteVerificationError` is raised if any blocks differ.
+    """
+    # Make sure the data is read from the device, not the page cache
+    fd = os.open(target_image.device, os.O_RDONLY)
+    try:
+        os.posix_fadvise(
+            fd,
+            target_image.offset,
+            manifest.size,
+            os.POSIX_FADV_DONTNEED,
+        )
+    finally:
+        os.close(fd)
+    differing_blocks = manifest.diff(manifest.measure(target_image))
+    if differing_blocks:
+        raise WriteVerificationError(
+            f"{target_image.kind.value} at {target_image.offset:#x} on "
+            f"{target_image.device} does not match after writing "
+            f"({manifest.block_size}-byte blocks "
+            f"{format_block_ranges(differing_blocks)} differ)"
+        )
+    log.info(
+        "Verified %s at %#x on %s (%s)",
+        target_image.kind.value,
+        target_image.offset,
+        target_image.device,
+        manifest.tagged_root,
+    )
+
+
+def verify_fat_write(new_image: FirmwareImage, target_image: FatFileImage):
+    """Check that a file on a FAT partition matches the image written to it.
+
+    The file's clusters are read back from the device, and
+    `WriteVerificationError` is raised if their digest doesn't match the
+    digest of `new_image`.
+    """
+    written_image = FatFileImage(
+        target_image.volume,
+        target_image.entry._replace(size=new_image.size),
+        target_image.clusters,
+        target_image.kind,
+        digest_name=new_image.digest_name,
+    )
+    # Make sure the data is read from the device, not the page cache
+    fd = os.open(written_image.device, os.O_RDONLY)
+    try:
+        for extent_offset, extent_size in written_image.extents:
+            os.posix_fadvise(
                 fd,
-                source.fileno(),
-                None,
-                source_image.size
+                extent_offset,
+                extent_size,
+                os.POSIX_FADV_DONTNEED,
+            )
+    finally:
+        os.close(fd)
+    if written_image != new_image:
+        raise WriteVerificationError(
+            f"{written_image.entry.name} on the FAT partition of "
+            f"{written_image.device} does not match {new_image.path} after "
+            f"writing"
+        )
+    log.info(
+        "Verified %s on the FAT partition of %s (%s)",
+        written_image.entry.name,
+        written_image.device,
+        written_image.tagged_digest,
+    )
+
+
+def confirm_overwrite(
+    action: MainAction,
+    destination_message: str,
+    source_message: str,
+) -> bool:
+    """Report an overwrite that could be made, and decide if it should be.
+
+    Depending on `action`, the overwrite is either just printed, printed and
+    approved, or the user is asked about it.
+    """
+    if action is MainAction.DRY_RUN:
+        print(
+            f"{destination_message} would be overwritten by "
+            f"{source_message}"
+        )
+        return False
+    elif action is MainAction.FORCE:
+        print(
+            f"{destination_message} will be overwritten with the contents "
+            f"of {source_message}"
+        )
+        return True
+    elif action is MainAction.INTERACTIVE:
+        response = input(
+            f"Should {destination_message} be overwritten by "
+            f"{source_message}? [y/N] "
+        )
+        cleaned_response = response.lower().strip()
+        if cleaned_response not in ("y", "yes"):
+            print("Skipping...")
+            return False
+        return True
+    else:
+        raise ValueError(f"Unknown action {action}")
+
+
+class SnapshotStore(object):
+    """A content-addressed store of images that have been overwritten.
+
+    Each image is stored once, named by its digest, no matter how many slots
+    it was taken from. Alongside each image is a small JSON file recording its
+    kind and the slots (device and offset) it was found in. When the store
+    grows past `max_size` bytes, the least recently used images are removed.
+    """
+
+    #: The digest algorithm images are stored by. This is always a secure hash
+    #: so that different images can't share a name.
+    DIGEST = "sha256"
+
+    #: The default maximum size of all stored images, in bytes.
+    DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+    #: The directory images are stored in.
+    directory: str
+
+    #: The maximum total size of the stored images.
+    max_size: int
+
+    def __init__(
+        self,
+        directory: os.PathLike,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ):
+        self.directory = os.fsdecode(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def _data_path(self, hexdigest: str) -> str:
+        return os.path.join(self.directory, hexdigest)
+
+    def _metadata_path(self, hexdigest: str) -> str:
+        return os.path.join(self.directory, f"{hexdigest}.json")
+
+    def digests(self) -> typing.List[str]:
+        """List the digests of every stored image, most recently used first."""
+        digests = [
+            name for name in os.listdir(self.directory)
+            if re.fullmatch(r"[0-9a-f]+", name)
+        ]
+        digests.sort(
+            key=lambda d: os.stat(self._data_path(d)).st_mtime_ns,
+            reverse=True,
+        )
+        return digests
+
+    def resolve(self, digest_prefix: str) -> str:
+        """Find the full digest of a stored image from a unique prefix.
+
+        The prefix may include the algorithm name (like "sha256:abc123").
+        `ValueError` is raised if no image or more than one image matches.
+        """
+        algorithm, _, prefix = digest_prefix.rpartition(":")
+        if algorithm and algorithm != self.DIGEST:
+            raise ValueError(f"Snapshots are stored by {self.DIGEST} digests")
+        matches = [d for d in self.digests() if d.startswith(prefix.lower())]
+        if len(matches) != 1:
+            raise ValueError(
+                f"{len(matches)} snapshots match '{digest_prefix}'"
+            )
+        return matches[0]
+
+    def metadata(self, hexdigest: str) -> typing.Dict[str, typing.Any]:
+        """Load the metadata for a stored image."""
+        with open(self._metadata_path(hexdigest), "r") as metadata_file:
+            return json.load(metadata_file)
+
+    def save(
+        self,
+        image: FirmwareImage,
+        keep: typing.Collection[str] = (),
+    ) -> str:
+        """Copy an image into the store, returning its digest.
+
+        The image is read in chunks, and written to a temporary file while it is
+        hashed. If an identical image is already stored, the copy is discarded
+        and only the list of slots for the stored image is updated. Stored
+        images with digests in `keep` are never evicted to make room.
+        """
+        if image.size > self.max_size:
+            log.warning(
+                "%s is larger than the snapshot store (%d bytes), not saving",
+                image,
+                self.max_size,
             )
-            assert write_size == source_image.size
-        except OSError:
-            # reraise it immediately; this except-clause is to satisfy the
-            # grammar so we can have an else-clause
+            return ""
+        hasher = new_hasher(self.DIGEST)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_file, \
+                    open_for_reading(image.device) as source:
+                for extent_offset, extent_size in image.extents:
+                    source.seek(extent_offset)
+                    remaining = extent_size
+                    while remaining > 0:
+                        chunk = source.read(min(HASH_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        hasher.update(chunk)
+                        temp_file.write(chunk)
+                        remaining -= len(chunk)
+                        watchdog.step()
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            hexdigest = hasher.hexdigest()
+            data_path = self._data_path(hexdigest)
+            if os.path.exists(data_path):
+                log.debug("%s is already stored as %s", image, hexdigest)
+                os.unlink(temp_path)
+                # Mark it as recently used
+                os.utime(data_path)
+            else:
+                os.replace(temp_path, data_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
             raise
-        else:
-            os.fsync(fd)
-        finally:
-            os.close(fd)
+        try:
+            metadata = self.metadata(hexdigest)
+        except FileNotFoundError:
+            metadata = {
+                "digest": self.DIGEST,
+                "kind": image.kind.name,
+                "size": image.size,
+                "slots": [],
+            }
+        slot = {"device": os.fsdecode(image.device), "offset": image.offset}
+        if isinstance(image, FatFileImage):
+            slot["file"] = image.entry.name
+        if slot not in metadata["slots"]:
+            metadata["slots"].append(slot)
+        write_atomically(self._metadata_path(hexdigest), json.dumps(metadata))
+        log.info(
+            "Saved snapshot of %s as %s:%s",
+            image,
+            self.DIGEST,
+            hexdigest,
+        )
+        self.evict(keep={hexdigest, *keep})
+        return hexdigest
 
+    def evict(self, keep: typing.Collection[str] = ()):
+        """Remove the least recently used images until under `max_size`.
 
-class MainAction(enum.Enum):
-    """The type of action to perform when invoked as a command."""
+        Images with digests in `keep` are never removed.
+        """
+        digests = self.digests()
+        sizes = {d: os.stat(self._data_path(d)).st_size for d in digests}
+        total_size = sum(sizes.values())
+        # digests() lists the most recently used first
+        for hexdigest in reversed(digests):
+            if total_size <= self.max_size:
+                break
+            if hexdigest in keep:
+                continue
+            log.info("Evicting snapshot %s:%s", self.DIGEST, hexdigest)
+            os.unlink(self._data_path(hexdigest))
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self._metadata_path(hexdigest))
+            total_size -= sizes[hexdigest]
 
-    #: Log which changes would be made, but don't change anything.
-    DRY_RUN = enum.auto()
+    def image(self, hexdigest: str) -> FirmwareImage:
+        """Get a stored image, checking that it hasn't been corrupted.
 
-    #: Interactively confirm each change before making it.
-    INTERACTIVE = enum.auto()
+        `ValueError` is raised if the stored data no longer matches its digest.
+        """
+        metadata = self.metadata(hexdigest)
+        stored_image = FirmwareImage(
+            self._data_path(hexdigest),
+            ImageKind[metadata["kind"]],
+            digest_name=self.DIGEST,
+        )
+        if stored_image.hexdigest != hexdigest:
+            raise ValueError(f"Snapshot {hexdigest} is corrupted")
+        # Mark it as recently used
+        os.utime(stored_image.path)
+        return stored_image
 
-    #: Make all changes without prompting for confirmation.
-    FORCE = enum.auto()
 
+def current_slot_image(slot_image: FirmwareImage) -> FirmwareImage:
+    """Find the image currently in a slot.
 
-def update_raw_beaglebone(
-    new_mlo_path: os.PathLike,
-    new_u_boot_path: os.PathLike,
+    If there's a valid image at the offset of `slot_image`, an image with its
+    actual size is returned. Otherwise `slot_image` is returned unchanged.
+    """
+    with open_for_reading(slot_image.device) as device:
+        device.seek(slot_image.offset)
+        try:
+            probed = probe_image(device)
+        except InvalidFirmwareImage as exc:
+            log.debug("%s", exc)
+            probed = None
+    if probed is None:
+        return slot_image
+    image_format, image_size = probed
+    return FirmwareImage(
+        slot_image.device,
+        slot_image.offset,
+        image_format.kind,
+        image_size,
+        digest_name=slot_image.digest_name,
+    )
+
+
+def rollback(
+    snapshots: SnapshotStore,
+    digest_prefix: str,
     devices: typing.Iterable[os.PathLike],
     action: MainAction,
 ) -> bool:
-    """Update a raw MMC device with updated firmware images.
+    """Restore a stored image to the slots it was taken from.
 
-    The source images are checked that they are able to be used as boot images,
-    then the given devices are searched for existing images. For any images
-    found, they are compared against the appropriate source image (MLO images to
-    MLO images, U-Boot to U-Boot). If the images on device are different, they
-    are (optionally) overwritten with the source images. The partition table is
-    also examined to ensure that the new images will not overlap with the
-    beginning of the first partition.
+    Only slots on the given devices are restored. The images being replaced are
+    themselves saved to the store first, and the writes go through the same
+    aligned write path as updates. Slots where the stored image would overlap
+    the first partition are skipped.
 
-    This function will raise `FileNotFoundError` for missing source files and
-    `ValueError` when the given files are not the right kind of image.
-    It returns a boolean for if there were outdated images present.
+    `ValueError` is raised if the digest doesn't match exactly one stored
+    image, or if the stored image is corrupted. It returns a boolean for if any
+    slots were left without the stored image.
+    """
+    hexdigest = snapshots.resolve(digest_prefix)
+    stored_image = snapshots.image(hexdigest)
+    device_names = {os.fsdecode(device) for device in devices}
+    remaining_slots = 0
+    for slot in snapshots.metadata(hexdigest)["slots"]:
+        if slot["device"] not in device_names:
+            log.debug("Skipping slot on unselected device %s", slot["device"])
+            continue
+        if "file" in slot:
+            log.error(
+                "%s on %s is a file on a FAT partition, and can't be rolled "
+                "back in place. Copy %s over it instead.",
+                slot["file"],
+                slot["device"],
+                stored_image.path,
+            )
+            remaining_slots += 1
+            continue
+        gap = get_partition_gap(slot["device"])
+        if gap is None or stored_image @ slot["offset"] >= gap[1]:
+            log.error(
+                "%s would overlap a partition on %s, skipping",
+                stored_image,
+                slot["device"],
+            )
+            remaining_slots += 1
+            continue
+        # The current contents of the slot are replaced with an image the
+        # same size as the stored one.
+        target_image = FirmwareImage(
+            slot["device"],
+            slot["offset"],
+            stored_image.kind,
+            stored_image.size,
+            digest_name=SnapshotStore.DIGEST,
+        )
+        if target_image == stored_image:
+            log.info("%s already matches %s", target_image, hexdigest)
+            continue
+        destination_message = (
+            f"{target_image.kind.value} at {target_image.offset:#x} "
+            f"on {target_image.device}"
+        )
+        source_message = (
+            f"snapshot {SnapshotStore.DIGEST}:{hexdigest} "
+            f"({stored_image.size} bytes)"
+        )
+        if not confirm_overwrite(action, destination_message, source_message):
+            remaining_slots += 1
+            continue
+        # The snapshot being restored has to survive making room for this one
+        snapshots.save(current_slot_image(target_image), keep={hexdigest})
+        copy_raw(
+            stored_image,
+            target_image,
+            plan_write(stored_image, target_image),
+        )
+        # Use a fresh image, as target_image has its old digest cached
+        restored_image = target_image @ target_image.offset
+        if restored_image != stored_image:
+            log.error(
+                "%s does not match snapshot %s after restoring it",
+                restored_image,
+                hexdigest,
+            )
+            remaining_slots += 1
+    return bool(remaining_slots)
+
+
+def check_source_paths(
+    new_mlo_path: os.PathLike,
+    new_u_boot_path: os.PathLike,
+):
+    """Check that the source files exist, and that the MLO file is valid.
+
+    `FileNotFoundError` is raised for missing files, and `ValueError` if the MLO
+    file does not have a valid TOC.
     """
     if not os.path.exists(new_mlo_path):
         raise FileNotFoundError(
@@ -708,7 +3279,7 @@ def update_raw_beaglebone(
             f"U-Boot file ({new_u_boot_path}) does not exist."
         )
     # Check that the files given are actually the appropriate kind of files.
-    with open(new_mlo_path, "rb") as mlo_file:
+    with open_for_reading(new_mlo_path) as mlo_file:
         try:
             get_mlo_toc_size(mlo_file)
         except InvalidFirmwareImage as exc:
@@ -716,66 +3287,595 @@ def update_raw_beaglebone(
             raise ValueError(
                 f"{new_mlo_path} does not have a valid TOC"
             ) from exc
-    with open(new_u_boot_path, "rb") as u_boot_file:
-        for get_size in (get_u_boot_fit_size, get_u_boot_legacy_size):
-            u_boot_file.seek(0)
-            try:
-                get_size(u_boot_file)
-            except InvalidUBootImage as exc:
-                log.debug("%s", exc)
-                raise ValueError(
-                    f"{new_u_boot_path} does not contain a U-Boot firmware"
-                    " image"
-                ) from exc
-            except InvalidFirmwareImage as exc:
-                log.debug("Not a U-Boot image because: %s", exc)
-                pass
-            else:
-                break
+
+
+@contextlib.contextmanager
+def checking_u_boot_source(new_u_boot_path: os.PathLike):
+    """Turn errors from checking a U-Boot source file into `ValueError`."""
+    try:
+        yield
+    except InvalidUBootImage as exc:
+        log.debug("%s", exc)
+        raise ValueError(
+            f"{new_u_boot_path} does not contain a U-Boot firmware image"
+        ) from exc
+    except InvalidFirmwareImage as exc:
+        log.debug("Not a U-Boot image because: %s", exc)
+        raise ValueError(
+            f"{new_u_boot_path} is not a valid U-Boot image"
+        ) from exc
+
+
+def require_u_boot(
+    probed: typing.Optional[typing.Tuple[ImageFormat, int]],
+):
+    """Raise `InvalidFirmwareImage` if a probed image isn't a U-Boot image."""
+    if probed is None:
+        raise InvalidFirmwareImage("No known image magic number found")
+    if probed[0].kind is not ImageKind.UBOOT:
+        raise InvalidFirmwareImage(f"Found a {probed[0].name} image instead")
+
+
+def check_fat_overwrite(
+    image: FatFileImage,
+    new_image: FirmwareImage,
+) -> bool:
+    """Check if a file on a FAT partition can be overwritten in place.
+
+    The partition can't be mounted, and the new image has to fit in the
+    clusters of the old file. The reason is logged if it can't be overwritten.
+    """
+    mount_point = find_mounted_partition(image.device, image.volume.offset)
+    if mount_point is not None:
+        log.error(
+            "Not overwriting %s on %s, as the partition is mounted at %s",
+            image.entry.name,
+            image.device,
+            mount_point,
+        )
+        return False
+    if not image.fits(new_image):
+        log.error(
+            (
+                "%s (%d bytes) does not fit in the %d %d-byte clusters of %s on "
+                "%s. Mount the partition and copy it instead."
+            ),
+            new_image.path,
+            new_image.size,
+            len(image.clusters),
+            image.volume.cluster_size,
+            image.entry.name,
+            image.device,
+        )
+        return False
+    return True
+
+
+def prepare_update(
+    image: FirmwareImage,
+    new_image: FirmwareImage,
+    action: MainAction,
+    metrics: UpdateMetrics,
+    snapshots: typing.Optional[SnapshotStore] = None,
+) -> bool:
+    """Report an outdated image, and decide if it should be overwritten.
+
+    If `action` allows overwriting it, the image is saved to `snapshots` (if
+    given) so that it's ready to be written with `write_update`. It returns if
+    the image should be overwritten.
+    """
+    metrics.add_outdated(image)
+    destination_message = (
+        f"{image.kind.value} at {image.offset:#x} "
+        f"({image.size} bytes) on {image.device}"
+    )
+    source_message = f"{new_image.path} ({new_image.size} bytes)"
+    is_fat_file = isinstance(image, FatFileImage)
+    if is_fat_file:
+        destination_message = (
+            f"{image.entry.name} ({image.size} bytes) on the FAT partition "
+            f"of {image.device}"
+        )
+    if not confirm_overwrite(action, destination_message, source_message):
+        return False
+    # Only check if the file can be written once it's actually going to be, so
+    # dry runs still report it while the partition is mounted.
+    if is_fat_file and not check_fat_overwrite(image, new_image):
+        return False
+    if snapshots is not None:
+        with metrics.phase("snapshot"):
+            snapshots.save(image)
+    return True
+
+
+class TargetWrite(typing.NamedTuple):
+    """The result of writing a new image over one target image."""
+
+    #: The image that was overwritten.
+    image: FirmwareImage
+
+    #: The number of bytes written.
+    size: int
+
+    #: How long writing (and flushing) took, in seconds.
+    elapsed: float
+
+    @property
+    def throughput(self) -> float:
+        """The write speed, in bytes per second."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.size / self.elapsed
+
+
+def write_update(
+    image: FirmwareImage,
+    new_image: FirmwareImage,
+    source_data: typing.Optional[bytes] = None,
+    manifest: typing.Optional[ImageManifest] = None,
+) -> TargetWrite:
+    """Overwrite an image with a new image, then verify it.
+
+    `source_data` is the already read contents of `new_image`, if there are
+    any. The new image is verified against `manifest` after it's written, if
+    one is given.
+    """
+    start = time.monotonic()
+    if isinstance(image, FatFileImage):
+        size = copy_to_fat(new_image, image, source_data)
+    else:
+        size = copy_raw(
+            new_image,
+            image,
+            plan_write(new_image, image),
+            source_data,
+        )
+    result = TargetWrite(image, size, time.monotonic() - start)
+    log.info(
+        "Wrote %d bytes of %s to %#x on %s in %.3fs (%.1f KiB/s)",
+        result.size,
+        image.kind.value,
+        image.offset,
+        image.device,
+        result.elapsed,
+        result.throughput / 1024,
+    )
+    if manifest is not None:
+        if isinstance(image, FatFileImage):
+            # Manifests are of contiguous ranges, which FAT files might not be
+            verify_fat_write(new_image, image)
         else:
-            raise ValueError(f"{new_u_boot_path} is not a valid U-Boot image")
-    new_mlo = FirmwareImage(new_mlo_path, ImageKind.MLO)
-    new_u_boot = FirmwareImage(new_u_boot_path, ImageKind.UBOOT)
+            verify_write(manifest, image)
+    return result
+
+
+def apply_update(
+    image: FirmwareImage,
+    new_image: FirmwareImage,
+    action: MainAction,
+    metrics: UpdateMetrics,
+    manifest: typing.Optional[ImageManifest] = None,
+    snapshots: typing.Optional[SnapshotStore] = None,
+) -> bool:
+    """Report an outdated image, and overwrite it if `action` allows.
+
+    The image is saved to `snapshots` before it is overwritten, and verified
+    against `manifest` afterwards, if they are given. It returns if the image
+    was overwritten.
+    """
+    if not prepare_update(image, new_image, action, metrics, snapshots):
+        return False
+    with metrics.phase("write"):
+        metrics.add_target_write(write_update(image, new_image, None, manifest))
+    return True
+
+
+def fan_out_updates(
+    updates: typing.Sequence[typing.Tuple[FirmwareImage, FirmwareImage]],
+    metrics: UpdateMetrics,
+    manifests: typing.Optional[
+        typing.Mapping[ImageKind, ImageManifest]
+    ] = None,
+) -> typing.List[TargetWrite]:
+    """Write new images over several target images at once.
+
+    `updates` is a sequence of (target image, new image) pairs, which should
+    already have been through `prepare_update`. Each new image is read once,
+    and the same data is written to every target it replaces. There's one
+    worker thread for each device, and each device's targets are written in
+    the order they're given. Written images are verified against `manifests`.
+
+    If writing to a device fails, no further targets on that device are
+    written, but the other devices are finished before the first error is
+    raised.
+    """
+    if manifests is None:
+        manifests = {}
+    source_data: typing.Dict[os.PathLike, bytes] = {}
+    device_updates: typing.Dict[
+        os.PathLike,
+        typing.List[typing.Tuple[FirmwareImage, FirmwareImage]],
+    ] = {}
+    for image, new_image in updates:
+        if new_image.path not in source_data:
+            source_data[new_image.path] = read_image(new_image)
+        device_updates.setdefault(image.device, []).append((image, new_image))
+    results: typing.List[TargetWrite] = []
+
+    def write_device(
+        queue: typing.List[typing.Tuple[FirmwareImage, FirmwareImage]],
+    ):
+        for image, new_image in queue:
+            # list.append() is atomic, so results can be shared
+            results.append(write_update(
+                image,
+                new_image,
+                source_data[new_image.path],
+                manifests.get(image.kind),
+            ))
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, len(device_updates)),
+        thread_name_prefix="am335x-writer",
+    ) as executor:
+        futures = [
+            executor.submit(write_device, queue)
+            for queue in device_updates.values()
+        ]
+    for result in results:
+        metrics.add_target_write(result)
+    for future in futures:
+        # Raise the first error, if there was one
+        future.result()
+    return results
+
+
+def update_raw_beaglebone(
+    new_mlo_path: os.PathLike,
+    new_u_boot_path: os.PathLike,
+    devices: typing.Iterable[os.PathLike],
+    action: MainAction,
+    digest_name: str = DEFAULT_DIGEST,
+    metrics: typing.Optional[UpdateMetrics] = None,
+    full_scan: bool = False,
+    use_manifests: bool = False,
+    snapshots: typing.Optional[SnapshotStore] = None,
+) -> bool:
+    """Update a raw MMC device with updated firmware images.
+
+    The source images are checked that they are able to be used as boot images,
+    then the given devices are searched for existing images. For any images
+    found, they are compared against the appropriate source image (MLO images to
+    MLO images, U-Boot to U-Boot). If the images on device are different, they
+    are (optionally) overwritten with the source images. The partition table is
+    also examined to ensure that the new images will not overlap with the
+    beginning of the first partition.
+
+    Images are compared using the digest algorithm named by `digest_name`
+    (which may be `AUTO_DIGEST` to pick the fastest one). If `metrics` is
+    given, timings, byte counts and outdated images are recorded in it. If
+    `full_scan` is true, the whole gap before the first partition is searched
+    for images instead of only the boot ROM offsets. If `use_manifests` is
+    true, an `ImageManifest` is kept next to each source image, which is used
+    for comparisons and to verify each image after it is written.
+
+    `WriteVerificationError` is raised if a written image does not read back
+    the same as its manifest.
+
+    If a `SnapshotStore` is given as `snapshots`, every image is saved to it
+    before it is overwritten.
+
+    Once every outdated image has been confirmed (and saved), each source image
+    is read once and written to all of its targets with `fan_out_updates`, with
+    the devices written to in parallel.
+
+    MLO and u-boot.img files on a FAT first partition are checked as well, and
+    are overwritten in place if the new image fits in the clusters of the old
+    file and the partition isn't mounted.
+
+    This function will raise `FileNotFoundError` for missing source files and
+    `ValueError` when the given files are not the right kind of image.
+    It returns a boolean for if there were outdated images present.
+    """
+    if metrics is None:
+        metrics = UpdateMetrics()
+    with metrics.phase("validate"):
+        check_source_paths(new_mlo_path, new_u_boot_path)
+        with open_for_reading(new_u_boot_path) as u_boot_file, \
+                checking_u_boot_source(new_u_boot_path):
+            require_u_boot(probe_image(u_boot_file))
+    new_mlo = FirmwareImage(
+        new_mlo_path,
+        ImageKind.MLO,
+        digest_name=digest_name,
+    )
+    new_u_boot = FirmwareImage(
+        new_u_boot_path,
+        ImageKind.UBOOT,
+        digest_name=digest_name,
+    )
     new_images = {
         ImageKind.MLO: new_mlo,
         ImageKind.UBOOT: new_u_boot,
     }
-    outdated_images = list(compare_images(new_mlo, new_u_boot, devices))
+    manifests = {}
+    if use_manifests:
+        with metrics.phase("manifest"):
+            manifests = {
+                kind: ImageManifest.load_or_generate(new_image)
+                for kind, new_image in new_images.items()
+            }
+    with metrics.phase("scan"):
+        outdated_images = list(compare_images(
+            new_mlo,
+            new_u_boot,
+            devices,
+            metrics,
+            full_scan,
+            manifests,
+        ))
     # Sort the images by kind, then device, then by offset
     outdated_images.sort(key=lambda i: (i.kind, i.device, i.offset))
-    for image in outdated_images:
-        destination_message = (
-            f"{image.kind.value} at {image.offset:#x} "
-            f"({image.size} bytes) on {image.device}"
+    # Prompts and snapshots happen one at a time, before anything is written
+    updates = [
+        (image, new_images[image.kind])
+        for image in outdated_images
+        if prepare_update(
+            image,
+            new_images[image.kind],
+            action,
+            metrics,
+            snapshots,
         )
-        source_message = (
-            f"{new_images[image.kind].path} "
-            f"({new_images[image.kind].size} bytes)"
-        )
-        if action is MainAction.DRY_RUN:
-            print(
-                f"{destination_message} would be overwritten by "
-                f"{source_message}"
-            )
-        elif action is MainAction.FORCE:
-            print(
-                f"{destination_message} will be overwritten with the contents "
-                f"of {source_message}"
-            )
-            copy_raw(new_images[image.kind], image)
-        elif action is MainAction.INTERACTIVE:
-            response = input(
-                f"Should {destination_message} be overwritten by "
-                f"{source_message}? [y/N] "
-            )
-            cleaned_response = response.lower().strip()
-            if cleaned_response not in ("y", "yes"):
-                print("Skipping...")
-            else:
-                copy_raw(new_images[image.kind], image)
+    ]
+    if updates:
+        with metrics.phase("write"):
+            fan_out_updates(updates, metrics, manifests)
+    metrics.success = len(updates) == len(outdated_images)
     return bool(outdated_images)
 
 
+#: The most threads the async API will use for blocking I/O at once.
+ASYNC_MAX_WORKERS = 2
+
+_async_executor: typing.Optional[concurrent.futures.Executor] = None
+
+
+def get_async_executor() -> concurrent.futures.Executor:
+    """Get the shared executor used by the async API for blocking I/O.
+
+    It is created the first time it's needed, with at most `ASYNC_MAX_WORKERS`
+    threads.
+    """
+    global _async_executor
+    if _async_executor is None:
+        _async_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=ASYNC_MAX_WORKERS,
+            thread_name_prefix="am335x-updater",
+        )
+    return _async_executor
+
+
+async def run_blocking(
+    executor: typing.Optional[concurrent.futures.Executor],
+    function: typing.Callable[..., typing.Any],
+    *args: typing.Any,
+) -> typing.Any:
+    """Run a blocking function in `executor` and wait for the result.
+
+    If `executor` is `None`, the shared executor from `get_async_executor` is
+    used. If the waiting task is cancelled, the function still runs to
+    completion in the executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or get_async_executor(),
+        functools.partial(function, *args),
+    )
+
+
+async def probe_image_async(
+    stream: io.BinaryIO,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+) -> typing.Optional[typing.Tuple[ImageFormat, int]]:
+    """The async version of `probe_image`."""
+    image_format = await run_blocking(executor, match_image_format, stream)
+    if image_format is None:
+        return None
+    if image_format.get_size_async is not None:
+        image_size = await image_format.get_size_async(stream, executor)
+    else:
+        image_size = await run_blocking(executor, image_format.get_size, stream)
+    return image_format, image_size
+
+
+async def find_images_async(
+    device_path: os.PathLike,
+    digest_name: str = DEFAULT_DIGEST,
+    scan_range: typing.Optional[typing.Tuple[int, int]] = None,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+    timeout: typing.Optional[float] = None,
+) -> typing.Collection[FirmwareImage]:
+    """The async version of `find_images`.
+
+    Each offset is probed as a separate step in `executor` (see
+    `run_blocking`). If `timeout` seconds pass, `asyncio.TimeoutError` is
+    raised.
+    """
+    async def find() -> typing.List[FirmwareImage]:
+        images: typing.List[FirmwareImage] = []
+        with open_for_reading(device_path) as device:
+            offsets = await run_blocking(
+                executor,
+                image_offsets,
+                device,
+                device_path,
+                scan_range,
+            )
+            for offset in offsets:
+                await run_blocking(
+                    executor,
+                    probe_for_image,
+                    images,
+                    device,
+                    device_path,
+                    offset,
+                    digest_name,
+                )
+        return images
+
+    return await asyncio.wait_for(find(), timeout)
+
+
+async def compare_images_async(
+    new_mlo: FirmwareImage,
+    new_u_boot: FirmwareImage,
+    device_paths: typing.Iterable[os.PathLike],
+    metrics: typing.Optional[UpdateMetrics] = None,
+    full_scan: bool = False,
+    manifests: typing.Optional[
+        typing.Mapping[ImageKind, ImageManifest]
+    ] = None,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+    timeout: typing.Optional[float] = None,
+) -> typing.Sequence[FirmwareImage]:
+    """The async version of `compare_images`.
+
+    Hashing and other device I/O is run in `executor` (see `run_blocking`). If
+    `timeout` seconds pass, `asyncio.TimeoutError` is raised.
+    """
+    if metrics is None:
+        metrics = UpdateMetrics()
+    if manifests is None:
+        manifests = {}
+
+    async def compare() -> typing.List[FirmwareImage]:
+        images_to_update = []
+        for device_path in device_paths:
+            with metrics.device_scan(device_path):
+                gap = await run_blocking(executor, get_scan_gap, device_path)
+                if gap is None:
+                    continue
+                images = await run_blocking(
+                    executor,
+                    add_fat_images,
+                    device_path,
+                    await find_images_async(
+                        device_path,
+                        new_mlo.digest_name,
+                        gap if full_scan else None,
+                        executor,
+                    ),
+                    gap[1],
+                    new_mlo.digest_name,
+                )
+                for image in images:
+                    if await run_blocking(
+                        executor,
+                        is_image_outdated,
+                        image,
+                        new_mlo,
+                        new_u_boot,
+                        gap[1],
+                        manifests,
+                    ):
+                        images_to_update.append(image)
+        return images_to_update
+
+    return await asyncio.wait_for(compare(), timeout)
+
+
+async def update_raw_beaglebone_async(
+    new_mlo_path: os.PathLike,
+    new_u_boot_path: os.PathLike,
+    devices: typing.Iterable[os.PathLike],
+    action: MainAction,
+    digest_name: str = DEFAULT_DIGEST,
+    metrics: typing.Optional[UpdateMetrics] = None,
+    full_scan: bool = False,
+    use_manifests: bool = False,
+    snapshots: typing.Optional[SnapshotStore] = None,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+    timeout: typing.Optional[float] = None,
+) -> bool:
+    """The async version of `update_raw_beaglebone`.
+
+    Blocking I/O is run in `executor` (see `run_blocking`), one step at a time,
+    so cancelling the task or hitting the `timeout` (which raises
+    `asyncio.TimeoutError`) stops the update between steps. An image that has
+    started being written is always finished, but no further images are
+    written. `MainAction.INTERACTIVE` is not supported, and raises
+    `ValueError`.
+    """
+    if action is MainAction.INTERACTIVE:
+        raise ValueError("Interactive updates are not supported when async")
+    if metrics is None:
+        metrics = UpdateMetrics()
+
+    async def update() -> bool:
+        with metrics.phase("validate"):
+            await run_blocking(
+                executor,
+                check_source_paths,
+                new_mlo_path,
+                new_u_boot_path,
+            )
+            with open_for_reading(new_u_boot_path) as u_boot_file, \
+                    checking_u_boot_source(new_u_boot_path):
+                require_u_boot(
+                    await probe_image_async(u_boot_file, executor)
+                )
+        new_images = {
+            kind: await run_blocking(
+                executor,
+                functools.partial(FirmwareImage, digest_name=digest_name),
+                path,
+                kind,
+            )
+            for kind, path in (
+                (ImageKind.MLO, new_mlo_path),
+                (ImageKind.UBOOT, new_u_boot_path),
+            )
+        }
+        manifests = {}
+        if use_manifests:
+            with metrics.phase("manifest"):
+                for kind, new_image in new_images.items():
+                    manifests[kind] = await run_blocking(
+                        executor,
+                        ImageManifest.load_or_generate,
+                        new_image,
+                    )
+        with metrics.phase("scan"):
+            outdated_images = list(await compare_images_async(
+                new_images[ImageKind.MLO],
+                new_images[ImageKind.UBOOT],
+                devices,
+                metrics,
+                full_scan,
+                manifests,
+                executor,
+            ))
+        outdated_images.sort(key=lambda i: (i.kind, i.device, i.offset))
+        remaining_images = 0
+        for image in outdated_images:
+            if not await run_blocking(
+                executor,
+                apply_update,
+                image,
+                new_images[image.kind],
+                action,
+                metrics,
+                manifests.get(image.kind),
+                snapshots,
+            ):
+                remaining_images += 1
+        metrics.success = remaining_images == 0
+        return bool(outdated_images)
+
+    return await asyncio.wait_for(update(), timeout)
+
+
 def parse_args() -> argparse.Namespace:
     """Parse command line arguments."""
     # This is pulled into a separate function to keep main() at a mangeable
@@ -850,6 +3950,91 @@ def parse_args() -> argparse.Namespace:
         )),
         dest="devices",
     )
+    parser.add_argument(
+        "--digest",
+        action="store",
+        choices=(*DIGEST_ALGORITHMS, AUTO_DIGEST),
+        help=(
+            "The digest algorithm used to compare images. 'auto' picks the "
+            f"fastest one on this device. (default: {DEFAULT_DIGEST})."
+        ),
+        default=DEFAULT_DIGEST,
+        dest="digest_name",
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help=(
+            "Search every sector before the first partition for bootloaders,"
+            " instead of only the offsets the boot ROM checks."
+        ),
+    )
+    parser.add_argument(
+        "--manifests",
+        action="store_true",
+        help=(
+            "Keep a manifest of per-block digests next to each bootloader file"
+            " (creating it if needed), and use it to compare and verify"
+            " installed bootloaders without rereading the bootloader files."
+        ),
+        dest="use_manifests",
+    )
+    parser.add_argument(
+        "--snapshot-dir",
+        action="store",
+        help=(
+            "Save every bootloader to this directory before it is overwritten,"
+            " so it can be restored later with --rollback."
+        ),
+        default=None,
+        metavar="/path/to/snapshots",
+    )
+    parser.add_argument(
+        "--snapshot-max-size",
+        action="store",
+        type=int,
+        help=(
+            "The maximum number of bytes of snapshots to keep. The least "
+            "recently used snapshots are removed first. (default: "
+            f"{SnapshotStore.DEFAULT_MAX_SIZE})."
+        ),
+        default=SnapshotStore.DEFAULT_MAX_SIZE,
+        metavar="BYTES",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store",
+        help=(
+            "Instead of updating, restore the snapshot with this digest (or "
+            "unique digest prefix) to the slots it was taken from. Requires "
+            "--snapshot-dir."
+        ),
+        default=None,
+        metavar="DIGEST",
+    )
+    parser.add_argument(
+        "--max-step-latency",
+        action="store",
+        type=float,
+        help=(
+            "When run under a systemd watchdog, the longest time in seconds a "
+            "single step of hashing, copying or flushing should take before "
+            "the watchdog is notified. (default: a quarter of the watchdog "
+            f"timeout, or {DEFAULT_MAX_STEP_LATENCY})."
+        ),
+        default=None,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        action="store",
+        help=(
+            "Write Prometheus metrics about this run to the given file, for use"
+            " with the node_exporter textfile collector."
+        ),
+        default=None,
+        metavar="/path/to/am335x_updater.prom",
+    )
     # Logging arguments
     logging_group = parser.add_mutually_exclusive_group()
     logging_group.add_argument(
@@ -869,10 +4054,14 @@ def parse_args() -> argparse.Namespace:
         help="Suppress all output.",
         dest="log_level",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.rollback is not None and args.snapshot_dir is None:
+        parser.error("--rollback requires --snapshot-dir")
+    return args
 
 
 def main() -> None:
+    global watchdog
     args = parse_args()
     # Update the log level first
     log_levels = {
@@ -905,22 +4094,61 @@ def main() -> None:
         if "am335x" not in model_name:
             log.error("This does not appear to be an AM335x device.")
             sys.exit(-1)
+    watchdog = Watchdog.from_environment(args.max_step_latency)
+    watchdog.step("Starting")
+    snapshots = None
+    if args.snapshot_dir is not None:
+        try:
+            snapshots = SnapshotStore(
+                args.snapshot_dir,
+                args.snapshot_max_size,
+            )
+        except OSError as exc:
+            log.error("Unable to open the snapshot store: %s", exc)
+            sys.exit(-1)
+    if args.rollback is not None:
+        try:
+            rollback_incomplete = rollback(
+                snapshots,
+                args.rollback,
+                args.devices,
+                args.action,
+            )
+        except (ValueError, OSError) as exc:
+            log.error("%s", exc)
+            sys.exit(-1)
+        except KeyboardInterrupt:
+            sys.exit(-1)
+        sys.exit(1 if rollback_incomplete else 0)
+    metrics = UpdateMetrics()
     try:
         bootloader_difference = update_raw_beaglebone(
             args.mlo,
             args.uboot,
             args.devices,
             args.action,
+            args.digest_name,
+            metrics,
+            args.full_scan,
+            args.use_manifests,
+            snapshots,
         )
-    except (ValueError, FileNotFoundError) as exc:
+    except (ValueError, FileNotFoundError, WriteVerificationError) as exc:
         log.error("%s", exc)
-        sys.exit(-1)
+        exit_status = -1
     except KeyboardInterrupt:
-        sys.exit(-1)
-    if bootloader_difference:
-        sys.exit(1)
+        exit_status = -1
     else:
-        sys.exit(0)
+        exit_status = 1 if bootloader_difference else 0
+    # The metrics are written once the update has returned (instead of from a
+    # finally-clause), so that only this process ever writes them.
+    if args.metrics_file is not None:
+        try:
+            metrics.write_textfile(args.metrics_file)
+        except OSError as exc:
+            log.error("Unable to write metrics: %s", exc)
+    watchdog.step("Finished")
+    sys.exit(exit_status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Compare hashing image data with and without the read/hash pipeline.
+
+Three ways of hashing are timed: reading the whole image then hashing it (how
+images used to be hashed), reading and hashing one chunk at a time, and the
+double-buffered pipeline from `hash_range`. `hash_range`'s default choice is
+timed as well. Each is run using every CPU, and then again pinned to a single
+CPU to show that single-core boards do not get slower. The page cache for the
+file is dropped before every run (where supported) so that the reads actually
+hit the device.
+
+Example:
+    sudo ./benchmarks/hash_pipeline.py --offset 0x60000 --size 0x100000 \\
+        /dev/mmcblk0
+"""
+
+import argparse
+import importlib.util
+import os
+import os.path
+import statistics
+import tempfile
+import time
+
+
+def load_updater():
+    """Import am335x-updater.py (which isn't importable by name)."""
+    script_path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "am335x-updater.py",
+    )
+    spec = importlib.util.spec_from_file_location("am335x_updater", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def drop_cache(path):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_then_hash(updater, path, offset, size, digest_name):
+    with open(path, "rb") as image:
+        image.seek(offset)
+        return updater.new_hasher(digest_name, image.read(size)).hexdigest()
+
+
+def chunked(updater, path, offset, size, digest_name):
+    hasher = updater.new_hasher(digest_name)
+    updater.hash_range(path, offset, size, hasher, pipelined=False)
+    return hasher.hexdigest()
+
+
+def pipelined(updater, path, offset, size, digest_name):
+    hasher = updater.new_hasher(digest_name)
+    updater.hash_range(path, offset, size, hasher, pipelined=True)
+    return hasher.hexdigest()
+
+
+def default(updater, path, offset, size, digest_name):
+    hasher = updater.new_hasher(digest_name)
+    updater.hash_range(path, offset, size, hasher)
+    return hasher.hexdigest()
+
+
+def time_method(method, updater, args):
+    timings = []
+    digests = set()
+    for _ in range(args.rounds):
+        drop_cache(args.path)
+        start = time.perf_counter()
+        digests.add(
+            method(updater, args.path, args.offset, args.size, args.digest)
+        )
+        timings.append(time.perf_counter() - start)
+    assert len(digests) == 1
+    return statistics.median(timings), digests.pop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "path",
+        nargs="?",
+        help="File or device to read (default: a temporary 16 MiB file).",
+    )
+    parser.add_argument("--offset", type=lambda n: int(n, 0), default=0)
+    parser.add_argument("--size", type=lambda n: int(n, 0), default=None)
+    parser.add_argument("--digest", default="sha256")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    updater = load_updater()
+    temp_file = None
+    if args.path is None:
+        temp_file = tempfile.NamedTemporaryFile()
+        temp_file.write(os.urandom(16 * 1024 * 1024))
+        temp_file.flush()
+        args.path = temp_file.name
+    if args.size is None:
+        args.size = os.stat(args.path).st_size - args.offset
+    methods = (
+        ("read then hash", read_then_hash),
+        ("chunked", chunked),
+        ("pipelined", pipelined),
+        ("default", default),
+    )
+    all_cpus = os.sched_getaffinity(0)
+    cpu_sets = [(f"{len(all_cpus)} CPUs", all_cpus)]
+    if len(all_cpus) > 1:
+        cpu_sets.append(("1 CPU", {min(all_cpus)}))
+    print(
+        f"Hashing {args.size} bytes of {args.path} at {args.offset:#x} with "
+        f"{args.digest}, median of {args.rounds} runs"
+    )
+    try:
+        for cpu_label, cpus in cpu_sets:
+            os.sched_setaffinity(0, cpus)
+            baseline = None
+            for method_label, method in methods:
+                elapsed, _ = time_method(method, updater, args)
+                if baseline is None:
+                    baseline = elapsed
+                print(
+                    f"{cpu_label:>8} {method_label:>15}: {elapsed * 1000:8.2f} "
+                    f"ms ({args.size / elapsed / 1024 / 1024:7.1f} MiB/s, "
+                    f"{baseline / elapsed:.2f}x)"
+                )
+    finally:
+        os.sched_setaffinity(0, all_cpus)
+        if temp_file is not None:
+            temp_file.close()
+
+
+if __name__ == "__main__":
+    main()